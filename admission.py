@@ -0,0 +1,232 @@
+"""
+Admission control for inference requests.
+
+Each worker process owns one AdmissionController that limits how many
+classifications run at once and holds a bounded number of requests in a
+priority queue. Interactive single uploads are always dispatched ahead of
+bulk/batch traffic, requests whose deadline has passed are dropped before
+they reach the model, and a full queue is rejected immediately so clients
+get a fast 429 instead of waiting for the gunicorn timeout.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+# Priority lanes - lower value is served first
+INTERACTIVE = 0
+BULK = 1
+
+LANES = {
+    'interactive': INTERACTIVE,
+    'bulk': BULK,
+    'batch': BULK,
+}
+
+
+class AdmissionError(Exception):
+    """Base class for requests that were not admitted to inference."""
+
+    def __init__(self, message, retry_after=1):
+        super(AdmissionError, self).__init__(message)
+        self.retry_after = max(1, int(round(retry_after)))
+
+
+class QueueFull(AdmissionError):
+    """Raised when the wait queue is full (or a bulk request was displaced)."""
+
+
+class DeadlineExceeded(AdmissionError):
+    """Raised when a request's deadline passes before it could be served."""
+
+
+class _Ticket(object):
+    __slots__ = ('lane', 'seq', 'deadline', 'state')
+
+    def __init__(self, lane, seq, deadline):
+        self.lane = lane
+        self.seq = seq
+        self.deadline = deadline
+        self.state = 'waiting'
+
+    def __lt__(self, other):
+        return (self.lane, self.seq) < (other.lane, other.seq)
+
+
+class AdmissionController(object):
+    """
+    Bounded, deadline-aware, priority scheduler for inference slots.
+
+    Args:
+        max_concurrent: Number of classifications allowed to run at once
+        max_queue: Maximum number of requests waiting for a slot
+        default_service_time: Initial estimate (seconds) of one inference,
+            used for Retry-After until real timings are observed
+    """
+
+    def __init__(self, max_concurrent=1, max_queue=8, default_service_time=1.0):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        if max_queue < 0:
+            raise ValueError("max_queue must not be negative")
+
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+
+        self._cond = threading.Condition()
+        self._heap = []
+        self._queued = 0
+        self._active = 0
+        self._seq = itertools.count()
+        self._service_time = float(default_service_time)
+
+    def is_saturated(self, priority=INTERACTIVE):
+        """
+        Cheap check used before parsing a request body.
+
+        Returns True if a request in the given lane would be rejected right
+        now. Interactive requests only see the queue as full if there is no
+        bulk waiter they could displace.
+        """
+        with self._cond:
+            if self._active < self.max_concurrent and self._queued == 0:
+                return False
+            if self._queued < self.max_queue:
+                return False
+            if priority == INTERACTIVE:
+                return self._find_displaceable() is None
+            return True
+
+    def retry_after(self):
+        """Estimate in seconds of how long until a new request could be served."""
+        with self._cond:
+            return self._estimate_wait(self._queued + 1)
+
+    def stats(self):
+        """Snapshot of the controller state for diagnostics."""
+        with self._cond:
+            return {
+                'active': self._active,
+                'queued': self._queued,
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'service_time': round(self._service_time, 4),
+            }
+
+    def acquire(self, priority=INTERACTIVE, deadline=None):
+        """
+        Wait for an inference slot.
+
+        Args:
+            priority: INTERACTIVE or BULK
+            deadline: Absolute time.monotonic() value after which the client
+                is no longer interested in the result, or None
+
+        Raises:
+            QueueFull: If the queue is full, or the request was displaced by
+                an interactive request while waiting
+            DeadlineExceeded: If the deadline passes before a slot is granted
+        """
+        with self._cond:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise DeadlineExceeded("Request deadline already passed")
+
+            if self._active < self.max_concurrent and self._queued == 0:
+                self._active += 1
+                return
+
+            if self._queued >= self.max_queue:
+                victim = self._find_displaceable() if priority == INTERACTIVE else None
+                if victim is None:
+                    raise QueueFull("Inference queue is full",
+                                    retry_after=self._estimate_wait(self._queued + 1))
+                victim.state = 'displaced'
+                self._queued -= 1
+                self._cond.notify_all()
+
+            ticket = _Ticket(priority, next(self._seq), deadline)
+            heapq.heappush(self._heap, ticket)
+            self._queued += 1
+
+            while ticket.state == 'waiting':
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        ticket.state = 'expired'
+                        self._queued -= 1
+                        break
+                self._cond.wait(timeout)
+
+            if ticket.state == 'granted':
+                return
+            if ticket.state == 'displaced':
+                raise QueueFull("Request displaced by higher-priority traffic",
+                                retry_after=self._estimate_wait(self._queued + 1))
+            raise DeadlineExceeded("Request deadline passed while queued")
+
+    def release(self, service_time=None):
+        """
+        Return a slot and hand it to the next eligible waiter.
+
+        Args:
+            service_time: Observed duration (seconds) of the work done while
+                holding the slot; feeds the Retry-After estimate
+        """
+        with self._cond:
+            self._active -= 1
+            if service_time is not None:
+                self._service_time = 0.8 * self._service_time + 0.2 * service_time
+            self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self._active < self.max_concurrent and self._heap:
+            ticket = heapq.heappop(self._heap)
+            if ticket.state != 'waiting':
+                continue
+            self._queued -= 1
+            if ticket.deadline is not None and now >= ticket.deadline:
+                # Client has already given up - don't spend a slot on it
+                ticket.state = 'expired'
+                continue
+            ticket.state = 'granted'
+            self._active += 1
+        self._cond.notify_all()
+
+    def _find_displaceable(self):
+        # Newest waiting bulk request is shed first
+        victim = None
+        for ticket in self._heap:
+            if ticket.state == 'waiting' and ticket.lane != INTERACTIVE:
+                if victim is None or ticket.seq > victim.seq:
+                    victim = ticket
+        return victim
+
+    def _estimate_wait(self, position):
+        rounds = float(position) / self.max_concurrent
+        return max(1.0, rounds * self._service_time)
+
+
+def parse_priority(value, default=INTERACTIVE):
+    """Map a lane name from a header/form field to a priority value."""
+    if not value:
+        return default
+    return LANES.get(str(value).strip().lower(), default)
+
+
+def parse_deadline(value, default_ms=None):
+    """
+    Convert a relative budget in milliseconds into an absolute deadline.
+
+    Returns None when no budget is given. Invalid values are ignored.
+    """
+    budget_ms = default_ms
+    if value:
+        try:
+            budget_ms = float(value)
+        except (TypeError, ValueError):
+            pass
+    if budget_ms is None or budget_ms <= 0:
+        return None
+    return time.monotonic() + budget_ms / 1000.0
@@ -1,10 +1,16 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, send_file, send_from_directory, abort, g, has_request_context
+from contextlib import contextmanager
 import os
-from werkzeug.utils import secure_filename
+import time
 import pathlib
 import random
 import torch
 
+from upload_store import UploadStore
+from model_utils import ImageTooLarge
+from admission import (AdmissionController, AdmissionError, DeadlineExceeded,
+                       INTERACTIVE, BULK, parse_priority, parse_deadline)
+
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
@@ -13,32 +19,99 @@ app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'webp'}
 # Model configuration: Set to 'DUMMY' for dummy model, 'REAL' for ML model
 app.config['MODEL_MODE'] = 'REAL' #'DUMMY'  # Change to 'REAL' when ML model is ready
 app.config['MODEL_PATH'] = 'model/lymphoma_clip_classifier.pth'
+app.config['CLIP_MODEL_ID'] = 'openai/clip-vit-large-patch14'
+
+# Inference optimizations applied at load time (see model_utils.optimize_for_inference).
+# Compilation is opt-in; its kernels are cached in MODEL_COMPILE_CACHE across restarts.
+app.config['MODEL_OPTIMIZE'] = os.getenv('MODEL_OPTIMIZE', '1') == '1'
+app.config['MODEL_COMPILE'] = os.getenv('MODEL_COMPILE', '0') == '1'
+app.config['MODEL_COMPILE_CACHE'] = 'model/compile_cache'
+
+# Optional manifest of named classifier heads (see model_registry.py). Workers
+# poll it, so new heads and canary routes go live without a restart.
+app.config['MODEL_REGISTRY_PATH'] = 'model/registry.json'
+app.config['MODEL_REGISTRY_POLL_SECONDS'] = 1.0
+
+# Optional similar-case retrieval (see embedding_index.py). When the index
+# exists, /upload responses include the NEIGHBORS_K most similar reference images.
+app.config['EMBEDDING_INDEX_PATH'] = 'model/embedding_index'
+app.config['NEIGHBORS_K'] = 5
+app.config['NEIGHBORS_NPROBE'] = 8
+
+# Admission control: concurrent inferences per worker, bounded wait queue and
+# optional default deadline (ms) for requests that don't send X-Deadline-Ms
+app.config['ADMISSION_MAX_CONCURRENT'] = int(os.getenv('ADMISSION_MAX_CONCURRENT', 1))
+app.config['ADMISSION_MAX_QUEUE'] = int(os.getenv('ADMISSION_MAX_QUEUE', 8))
+app.config['ADMISSION_DEFAULT_DEADLINE_MS'] = float(os.getenv('ADMISSION_DEFAULT_DEADLINE_MS', 0)) or None
+app.config['MAX_BATCH_FILES'] = 32
+
+# Upload store budget: originals are evicted least-recently-used first once
+# the store grows past UPLOAD_STORE_MAX_BYTES or isn't accessed for UPLOAD_STORE_MAX_AGE seconds
+app.config['UPLOAD_STORE_MAX_BYTES'] = int(os.getenv('UPLOAD_STORE_MAX_BYTES', 512 * 1024 * 1024))
+app.config['UPLOAD_STORE_MAX_AGE'] = int(os.getenv('UPLOAD_STORE_MAX_AGE', 7 * 24 * 3600))
+app.config['UPLOAD_CACHE_MAX_AGE'] = 365 * 24 * 3600  # Stored objects never change
 
 # Create uploads directory if it doesn't exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Relative to the app like send_file/send_from_directory, not the working directory
+upload_root = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
+os.makedirs(upload_root, exist_ok=True)
+
+# Content-addressed store for uploads (lives in uploads/objects and uploads/thumbs)
+upload_store = UploadStore(
+    upload_root,
+    max_bytes=app.config['UPLOAD_STORE_MAX_BYTES'],
+    max_age=app.config['UPLOAD_STORE_MAX_AGE']
+)
 
 # Global variables for ML model (loaded once at startup)
 ml_model = None
 ml_processor = None
+ml_registry = None
+embedding_index = None
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+# Per-process scheduler in front of inference
+admission = AdmissionController(
+    max_concurrent=app.config['ADMISSION_MAX_CONCURRENT'],
+    max_queue=app.config['ADMISSION_MAX_QUEUE']
+)
+
 def load_ml_model():
     """Load the ML model once at application startup."""
-    global ml_model, ml_processor
+    global ml_model, ml_processor, ml_registry, embedding_index
     
     if app.config['MODEL_MODE'] == 'REAL':
         try:
             from model_utils import load_model
+            from model_registry import ModelRegistry
             
             print(f"Loading ML model from {app.config['MODEL_PATH']}...")
             print(f"Using device: {device}")
             
             # Load model
-            ml_model = load_model(app.config['MODEL_PATH'], device=device)
+            ml_model = load_model(app.config['MODEL_PATH'], device=device,
+                                  model_id=app.config['CLIP_MODEL_ID'],
+                                  optimize=app.config['MODEL_OPTIMIZE'],
+                                  compile_model=app.config['MODEL_COMPILE'],
+                                  compile_cache_dir=app.config['MODEL_COMPILE_CACHE'])
+            
+            # Every head shares the encoder of the model loaded above
+            ml_registry = ModelRegistry(ml_model, device=device, fuse_heads=app.config['MODEL_OPTIMIZE'])
+            ml_registry.add_head('default', ml_model.classifier)
+            ml_registry.set_routes('default')
+            if os.path.exists(app.config['MODEL_REGISTRY_PATH']):
+                ml_registry.load_manifest(app.config['MODEL_REGISTRY_PATH'])
+                print(f"Model registry loaded: {ml_registry.status()}")
             
-            # Get processor from the model - must match the model_id used in training
-            from transformers import CLIPProcessor
-            ml_processor = CLIPProcessor.from_pretrained("openai/clip-vit-large-patch14")
+            # Get processor from the model - must match the model_id used in training.
+            # Only image preprocessing is needed, so the tokenizer isn't loaded.
+            from transformers import CLIPImageProcessor
+            ml_processor = CLIPImageProcessor.from_pretrained(app.config['CLIP_MODEL_ID'])
+            
+            if os.path.exists(os.path.join(app.config['EMBEDDING_INDEX_PATH'], 'meta.json')):
+                from embedding_index import EmbeddingIndex
+                embedding_index = EmbeddingIndex(app.config['EMBEDDING_INDEX_PATH'], readonly=True)
+                print(f"Embedding index loaded with {len(embedding_index)} reference images")
             
             print("ML model loaded successfully!")
         except Exception as e:
@@ -65,56 +138,179 @@ def classify_with_dummy_model(filepath, filename):
         'High-grade malignant lymphoma characterized by large B-cells.'
     )
 
-def classify_with_ml_model(filepath, filename):
+def classify_with_ml_model(filepath, filename, details=None, explain=False):
     """
     Real ML model classification function using CLIP-based classifier.
+    The classifier head is chosen by the model registry (primary or canary);
+    its name is reported in details['model_version']. With explain, an
+    attention-rollout heatmap is added as details['heatmap'].
     
     Returns: (prediction, confidence, description)
     """
-    global ml_model, ml_processor
+    global ml_model, ml_processor, ml_registry
     
-    if ml_model is None or ml_processor is None:
+    if ml_registry is None or ml_processor is None:
         raise RuntimeError("ML model not loaded. Make sure MODEL_MODE is set to 'REAL' and model file exists.")
     
     try:
         from model_utils import predict_image
         
+        ml_registry.refresh(app.config['MODEL_REGISTRY_PATH'],
+                            interval=app.config['MODEL_REGISTRY_POLL_SECONDS'])
+        model_version, model = ml_registry.route(key=filename)
+        
         # Run inference
+        if details is None:
+            details = {}
+        details['model_version'] = model_version
         prediction, confidence, description = predict_image(
-            model=ml_model,
+            model=model,
             image_path=filepath,
             processor=ml_processor,
             device=device,
-            class_names=['DLBCL', 'Follicular', 'Hodgkin']
+            class_names=['DLBCL', 'Follicular', 'Hodgkin'],
+            details=details,
+            explain=explain
         )
         
+        if embedding_index is not None:
+            try:
+                details['neighbors'] = find_neighbors(details['embedding'])
+            except Exception as e:
+                # Retrieval is an extra: keep the real prediction without neighbors
+                print(f"Error finding similar cases: {e}")
+        
+        decode = details.get('decode')
+        if decode:
+            # Part of 'infer'; reported separately so load tests can see it
+            add_timing('decode', decode['decode_ms'])
+            if decode['est_saved_ms'] is not None:
+                add_timing('decode_saved', decode['est_saved_ms'])
+        
         return prediction, confidence, description
         
+    except ImageTooLarge:
+        # A problem with the input, not the model: a dummy result here would
+        # look like a real diagnosis
+        raise
     except Exception as e:
         # Fallback to dummy model if ML model fails
         print(f"Error in ML model inference: {e}")
         return classify_with_dummy_model(filepath, filename)
 
-def classify_image(filepath, filename):
+def find_neighbors(embedding):
+    """
+    Most similar reference images for an embedding.
+    Returns: list of {'id', 'score'} dicts, best first
+    """
+    embedding_index.refresh()
+    neighbors = embedding_index.search(
+        embedding.numpy(),
+        k=app.config['NEIGHBORS_K'],
+        nprobe=app.config['NEIGHBORS_NPROBE']
+    )[0]
+    # float16/int8 storage can push cosine similarity marginally above 1
+    return [{'id': ref_id, 'score': round(min(score, 1.0), 4)} for ref_id, score in neighbors]
+
+def classify_image(filepath, filename, details=None, explain=False):
     """
     Main classification function that routes to either dummy or real model
     based on configuration.
+    details: Optional dict that receives extra per-request results
+    explain: Request a saliency heatmap (REAL mode only)
     Returns: (prediction, confidence, description)
     """
     if app.config['MODEL_MODE'] == 'DUMMY':
         return classify_with_dummy_model(filepath, filename)
     elif app.config['MODEL_MODE'] == 'REAL':
-        return classify_with_ml_model(filepath, filename)
+        return classify_with_ml_model(filepath, filename, details=details, explain=explain)
     else:
         raise ValueError(f"Invalid MODEL_MODE: {app.config['MODEL_MODE']}. Must be 'DUMMY' or 'REAL'.")
 
+def add_timing(phase, duration_ms):
+    """Add duration_ms to this request's Server-Timing header entry for phase."""
+    if not has_request_context():
+        return
+    timings = g.setdefault('timings', {})
+    timings[phase] = timings.get(phase, 0.0) + duration_ms
+
+@contextmanager
+def timed(phase):
+    """Add the duration of the block to this request's Server-Timing header."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(phase, (time.perf_counter() - start) * 1000)
+
+@app.after_request
+def add_server_timing(response):
+    # Lets load tests separate multipart parsing, file I/O, queueing and inference
+    timings = g.get('timings')
+    if timings:
+        response.headers['Server-Timing'] = ', '.join(
+            f'{phase};dur={duration:.2f}' for phase, duration in timings.items()
+        )
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def save_upload(file):
+    """
+    Save an uploaded file into the content-addressed store.
+    Returns: (store name, path on disk)
+    """
+    # allowed_file has already checked the extension; secure_filename would drop
+    # it entirely for names without an ASCII stem (e.g. '图像.png' -> 'png')
+    extension = file.filename.rsplit('.', 1)[1].lower()
+    with timed('store'):
+        name = upload_store.put(file.stream, extension)
+    return name, upload_store.object_path(name)
+
+def admission_rejected(error):
+    """Build the 429/503 response for a request that was not admitted."""
+    status = 503 if isinstance(error, DeadlineExceeded) else 429
+    response = jsonify({'error': str(error)})
+    response.status_code = status
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def request_deadline():
+    """Absolute deadline for this request from the X-Deadline-Ms header."""
+    return parse_deadline(request.headers.get('X-Deadline-Ms'),
+                          default_ms=app.config['ADMISSION_DEFAULT_DEADLINE_MS'])
+
+def classify_admitted(filepath, filename, priority, deadline, details=None, explain=False):
+    """Run classify_image once the admission controller grants a slot."""
+    with timed('queue'):
+        admission.acquire(priority=priority, deadline=deadline)
+    start = time.monotonic()
+    try:
+        with timed('infer'):
+            return classify_image(filepath, filename, details=details, explain=explain)
+    finally:
+        admission.release(service_time=time.monotonic() - start)
+
+def explain_requested():
+    """Whether the client asked for a saliency heatmap (?explain=1 or form field)."""
+    value = request.args.get('explain') or request.form.get('explain') or ''
+    return value.lower() in ('1', 'true', 'yes')
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    if 'file' not in request.files:
+    priority = parse_priority(request.headers.get('X-Priority'), default=INTERACTIVE)
+    deadline = request_deadline()
+
+    # Shed load before the multipart body is parsed and written to disk
+    if admission.is_saturated(priority):
+        return admission_rejected(AdmissionError("Inference queue is full",
+                                                 retry_after=admission.retry_after()))
+
+    with timed('parse'):
+        has_file = 'file' in request.files
+    if not has_file:
         return jsonify({'error': 'No file provided'}), 400
     
     file = request.files['file']
@@ -123,29 +319,137 @@ def upload_file():
         return jsonify({'error': 'No file selected'}), 400
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        filename, filepath = save_upload(file)
         
         # Classify image using the configured model (dummy or real ML)
-        prediction, confidence, description = classify_image(filepath, filename)
+        details = {}
+        try:
+            prediction, confidence, description = classify_admitted(filepath, filename, priority, deadline,
+                                                                    details=details, explain=explain_requested())
+        except AdmissionError as e:
+            return admission_rejected(e)
+        except ImageTooLarge as e:
+            return jsonify({'error': str(e)}), 413
         
         # Return result with image path
-        return jsonify({
+        result = {
             'success': True,
             'image_url': f'/uploads/{filename}',
+            'thumbnail_url': f'/uploads/thumbs/{filename}',
             'prediction': prediction,
             'confidence': confidence,
             'description': description
-        })
+        }
+        if 'model_version' in details:
+            result['model_version'] = details['model_version']
+        if 'neighbors' in details:
+            result['neighbors'] = details['neighbors']
+        if 'heatmap' in details:
+            result['heatmap'] = details['heatmap']
+        return jsonify(result)
     
     return jsonify({'error': 'Invalid file type. Please upload JPG, PNG, or WebP.'}), 400
 
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """
+    Classify several images in one request.
+    Batch traffic is scheduled in the bulk lane, behind interactive uploads.
+    """
+    deadline = request_deadline()
+
+    if admission.is_saturated(BULK):
+        return admission_rejected(AdmissionError("Inference queue is full",
+                                                 retry_after=admission.retry_after()))
+
+    with timed('parse'):
+        files = [f for f in request.files.getlist('files') if f.filename != '']
+    if not files:
+        return jsonify({'error': 'No files provided'}), 400
+    if len(files) > app.config['MAX_BATCH_FILES']:
+        return jsonify({'error': f"Too many files. Maximum is {app.config['MAX_BATCH_FILES']}."}), 400
+
+    results = []
+    for file in files:
+        if not allowed_file(file.filename):
+            results.append({'filename': file.filename, 'error': 'Invalid file type'})
+            continue
+
+        filename, filepath = save_upload(file)
+
+        details = {}
+        try:
+            prediction, confidence, description = classify_admitted(filepath, filename, BULK, deadline,
+                                                                    details=details)
+        except AdmissionError as e:
+            # Stop the batch - the remaining files would be rejected as well
+            response = admission_rejected(e)
+            if results:
+                response.set_data(jsonify({'error': str(e), 'results': results}).get_data())
+            return response
+        except ImageTooLarge as e:
+            results.append({'filename': file.filename, 'error': str(e)})
+            continue
+
+        result = {
+            'filename': file.filename,
+            'image_url': f'/uploads/{filename}',
+            'thumbnail_url': f'/uploads/thumbs/{filename}',
+            'prediction': prediction,
+            'confidence': confidence,
+            'description': description
+        }
+        if 'model_version' in details:
+            result['model_version'] = details['model_version']
+        if 'neighbors' in details:
+            result['neighbors'] = details['neighbors']
+        results.append(result)
+
+    return jsonify({'success': True, 'results': results})
+
+@app.route('/admission')
+def admission_status():
+    return jsonify(admission.stats())
+
+@app.route('/models')
+def models_status():
+    if ml_registry is None:
+        return jsonify({'heads': [], 'routes': {}})
+    return jsonify(ml_registry.status())
+
+def send_stored(path, etag):
+    """Serve an immutable stored object with validators and a long cache lifetime."""
+    response = send_file(
+        path,
+        etag=etag,
+        last_modified=os.path.getmtime(path),
+        max_age=app.config['UPLOAD_CACHE_MAX_AGE'],
+        conditional=True
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    from flask import send_from_directory
+    found = upload_store.lookup(filename)
+    if found is not None:
+        path, etag = found
+        return send_stored(path, etag)
+
+    # Files saved before the content-addressed store was introduced
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+@app.route('/uploads/thumbs/<filename>')
+def uploaded_thumbnail(filename):
+    try:
+        path = upload_store.thumbnail_path(filename)
+    except ValueError:
+        path = None
+    if path is None:
+        abort(404)
+    return send_stored(path, f"{filename.split('.', 1)[0]}-thumb")
+
 if __name__ == '__main__':
     # Load ML model if in REAL mode
     if app.config['MODEL_MODE'] == 'REAL':
@@ -0,0 +1,651 @@
+"""
+Sharded bulk inference over a shared work queue.
+
+Classifies large image sets (e.g. a whole slide archive) on any number of
+nodes that can see the same shared folder. There is no broker: the queue is a
+SQLite database in the work folder, and workers coordinate through leases.
+
+    plan    splits the input list into shards (one text file of paths each)
+            and creates the queue
+    work    claims shards, runs batched inference and writes one JSONL output
+            per shard; start it on as many nodes/processes as needed
+    status  shows progress, live leases and failed shards
+    retry   puts failed shards back in the queue
+    merge   combines the shard outputs into one CSV (or JSONL) file
+
+A worker renews its lease while it works. If it crashes (or its node goes
+away), the lease expires and another worker picks the shard up again; shard
+outputs are written to a temporary file and renamed into place, so a shard
+is either complete or absent. Shards that fail max_attempts times are marked
+failed instead of being retried forever. Errors that are not caused by the
+shard itself (the model failing to load, device or memory errors) stop the
+worker and hand the shard back without using up one of its attempts, so one
+misconfigured node cannot fail the whole queue.
+
+Layout:
+    <work>/queue.sqlite
+    <work>/shards/shard-000001.txt
+    <work>/outputs/shard-000001.jsonl
+
+Usage:
+    python bulk.py plan --input /data/slides --work /shared/run1 --shard-size 500
+    python bulk.py work --work /shared/run1        # on every node
+    python bulk.py status --work /shared/run1
+    python bulk.py retry --work /shared/run1 --failed
+    python bulk.py merge --work /shared/run1 --output predictions.csv
+"""
+import argparse
+import csv
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from model_utils import is_valid_image
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+# Same order as the classifier's outputs (see model_utils.predict_images)
+CLASS_NAMES = ['DLBCL', 'Follicular', 'Hodgkin']
+
+
+class LeaseLost(Exception):
+    """The worker's lease on a shard expired and may have been given to another worker."""
+    pass
+
+
+class ShardError(Exception):
+    """A problem with the shard itself; it counts towards the shard's max_attempts."""
+    pass
+
+
+class ShardQueue(object):
+    """
+    Lease-based shard queue in a SQLite database on shared storage.
+
+    Every operation opens its own short-lived connection, so the queue can be
+    used from several threads and the database file is never held open
+    between calls. Claims run in an IMMEDIATE transaction, so two workers
+    never lease the same shard.
+
+    Args:
+        path: Database file
+        lease_seconds: How long a claim is valid without being renewed
+        max_attempts: Claims per shard before it is marked failed
+        timeout: Seconds to wait for the database lock
+    """
+
+    def __init__(self, path, lease_seconds=300.0, max_attempts=3, timeout=60.0):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS shards (
+                    id INTEGER PRIMARY KEY,
+                    input TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    owner TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    output TEXT,
+                    error TEXT
+                )
+            """)
+
+    def _connect(self):
+        # Autocommit mode so transactions are started explicitly. The default
+        # rollback journal is kept: WAL needs shared memory, which does not
+        # work across nodes on network filesystems.
+        return _Connection(sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None))
+
+    def add(self, shards):
+        """
+        Add shards to the queue.
+
+        Args:
+            shards: Iterable of (shard id, input file, number of images)
+        """
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("INSERT INTO shards (id, input, size) VALUES (?, ?, ?)", shards)
+            db.execute("COMMIT")
+
+    def claim(self, owner):
+        """
+        Lease the next available shard: a pending one, or one whose lease expired.
+
+        Returns:
+            Tuple of (shard id, input file), or None if nothing is available
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # Shards that keep taking their workers down are not handed out again
+                db.execute(
+                    "UPDATE shards SET status = ?, owner = NULL, error = COALESCE(error, 'lease expired') "
+                    "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                    (FAILED, LEASED, now, self.max_attempts)
+                )
+                row = db.execute(
+                    "SELECT id, input, status, owner FROM shards "
+                    "WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY id LIMIT 1",
+                    (PENDING, LEASED, now)
+                ).fetchone()
+                if row is not None:
+                    db.execute(
+                        "UPDATE shards SET status = ?, owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                        "WHERE id = ?",
+                        (LEASED, owner, now + self.lease_seconds, row[0])
+                    )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+        shard_id, input_path, status, previous_owner = row
+        if status == LEASED:
+            print(f"Reclaimed shard {shard_id} from {previous_owner} (lease expired)")
+        return shard_id, input_path
+
+    def renew(self, shard_id, owner):
+        """Extend a lease. Returns False if the lease was lost."""
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE shards SET lease_expires = ? WHERE id = ? AND owner = ? AND status = ?",
+                (time.time() + self.lease_seconds, shard_id, owner, LEASED)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, shard_id, owner, output):
+        """Mark a leased shard done. Returns False if the lease was lost."""
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE shards SET status = ?, output = ?, lease_expires = NULL, error = NULL "
+                "WHERE id = ? AND owner = ? AND status = ?",
+                (DONE, output, shard_id, owner, LEASED)
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, shard_id, owner, error):
+        """Give a shard back after an error; it is retried until max_attempts."""
+        with self._connect() as db:
+            db.execute(
+                "UPDATE shards SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                "owner = NULL, lease_expires = NULL, error = ? "
+                "WHERE id = ? AND owner = ? AND status = ?",
+                (self.max_attempts, FAILED, PENDING, str(error), shard_id, owner, LEASED)
+            )
+
+    def release(self, shard_id, owner):
+        """Give a shard back untouched: its claim does not count as an attempt."""
+        with self._connect() as db:
+            db.execute(
+                "UPDATE shards SET status = ?, owner = NULL, lease_expires = NULL, attempts = attempts - 1 "
+                "WHERE id = ? AND owner = ? AND status = ?",
+                (PENDING, shard_id, owner, LEASED)
+            )
+
+    def requeue(self, shard_ids=None):
+        """
+        Put failed shards back in the queue with a fresh set of attempts.
+
+        Args:
+            shard_ids: Only requeue these shards (default: every failed shard)
+
+        Returns:
+            Number of shards requeued
+        """
+        query = "UPDATE shards SET status = ?, attempts = 0, error = NULL WHERE status = ?"
+        params = [PENDING, FAILED]
+        if shard_ids is not None:
+            shard_ids = list(shard_ids)
+            query += f" AND id IN ({', '.join('?' * len(shard_ids))})"
+            params += shard_ids
+        with self._connect() as db:
+            return db.execute(query, params).rowcount
+
+    def counts(self):
+        """Number of shards and images per status."""
+        counts = {status: {'shards': 0, 'images': 0} for status in (PENDING, LEASED, DONE, FAILED)}
+        with self._connect() as db:
+            for status, shards, images in db.execute(
+                "SELECT status, COUNT(*), SUM(size) FROM shards GROUP BY status"
+            ):
+                counts[status] = {'shards': shards, 'images': images or 0}
+        return counts
+
+    def shards(self, status=None):
+        """Shard rows as dicts, in shard order, optionally filtered by status."""
+        query = "SELECT id, input, size, status, owner, lease_expires, attempts, output, error FROM shards"
+        params = ()
+        if status is not None:
+            query += " WHERE status = ?"
+            params = (status,)
+        columns = ['id', 'input', 'size', 'status', 'owner', 'lease_expires', 'attempts', 'output', 'error']
+        with self._connect() as db:
+            return [dict(zip(columns, row)) for row in db.execute(query + " ORDER BY id", params)]
+
+    def unfinished(self):
+        """Number of shards that are neither done nor failed."""
+        with self._connect() as db:
+            return db.execute(
+                "SELECT COUNT(*) FROM shards WHERE status IN (?, ?)", (PENDING, LEASED)
+            ).fetchone()[0]
+
+
+class _Connection(object):
+    """sqlite3 connection that is closed (not just committed) on leaving a with block."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, *exc_info):
+        self.db.close()
+
+
+class _Heartbeat(threading.Thread):
+    """Renews a shard lease in the background while the worker is busy."""
+
+    def __init__(self, queue, shard_id, owner, interval):
+        super(_Heartbeat, self).__init__(daemon=True)
+        self.queue = queue
+        self.shard_id = shard_id
+        self.owner = owner
+        self.interval = interval
+        self.lost = threading.Event()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                renewed = self.queue.renew(self.shard_id, self.owner)
+            except sqlite3.Error as e:
+                # Transient lock contention; the lease is still valid for a while
+                print(f"Error renewing lease on shard {self.shard_id}: {e}")
+                continue
+            if not renewed:
+                self.lost.set()
+                return
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def plan(input_path, work_dir, shard_size=500, lease_seconds=300.0, max_attempts=3):
+    """
+    Split the input into shards and create the queue.
+
+    Args:
+        input_path: Folder of images (searched recursively) or a manifest
+            file with one image path per line
+        work_dir: Shared work folder; must not contain a queue yet
+        shard_size: Images per shard
+
+    Returns:
+        ShardQueue for the new work folder
+    """
+    queue_path = os.path.join(work_dir, 'queue.sqlite')
+    if os.path.exists(queue_path):
+        raise FileExistsError(f"{work_dir} already has a queue; use a new work folder")
+
+    shards_dir = os.path.join(work_dir, 'shards')
+    os.makedirs(shards_dir, exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'outputs'), exist_ok=True)
+
+    shards = []
+    batch = []
+    for path in _input_paths(input_path):
+        batch.append(path)
+        if len(batch) == shard_size:
+            shards.append(_write_shard(shards_dir, len(shards) + 1, batch))
+            batch = []
+    if batch:
+        shards.append(_write_shard(shards_dir, len(shards) + 1, batch))
+
+    queue = ShardQueue(queue_path, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    queue.add(shards)
+    return queue
+
+
+def _input_paths(input_path):
+    if os.path.isdir(input_path):
+        for dirpath, dirnames, filenames in os.walk(input_path):
+            # Skip hidden/system folders such as .ipynb_checkpoints
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for filename in sorted(filenames):
+                if is_valid_image(filename):
+                    yield os.path.abspath(os.path.join(dirpath, filename))
+        return
+
+    with open(input_path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def _write_shard(shards_dir, shard_id, paths):
+    name = f"shard-{shard_id:06d}.txt"
+    with open(os.path.join(shards_dir, name), 'w') as f:
+        f.write('\n'.join(paths) + '\n')
+    return shard_id, os.path.join('shards', name), len(paths)
+
+
+class Worker(object):
+    """
+    Claims shards until the queue is drained and writes their predictions.
+
+    Args:
+        queue: ShardQueue of the work folder
+        work_dir: Shared work folder
+        predict: Callable taking a list of image paths and returning one
+            result dict per path (see model_utils.predict_images)
+        batch_size: Images per call to predict
+        heartbeat_interval: Seconds between lease renewals (defaults to a
+            third of the lease)
+        poll_interval: Seconds to wait when every unfinished shard is leased
+            by another worker
+    """
+
+    def __init__(self, queue, work_dir, predict, batch_size=16, heartbeat_interval=None, poll_interval=10.0):
+        self.queue = queue
+        self.work_dir = work_dir
+        self.predict = predict
+        self.batch_size = batch_size
+        self.heartbeat_interval = heartbeat_interval or queue.lease_seconds / 3.0
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+    def run(self, wait=True):
+        """
+        Process shards until none are left.
+
+        Args:
+            wait: Keep polling while other workers hold leases, so shards of
+                workers that crash are still picked up by this one
+
+        Returns:
+            Dict of counts: shards, images, errors (images that failed to decode)
+
+        Raises:
+            Any error that is not specific to a shard, after handing the
+            shard back to the queue
+        """
+        stats = dict(shards=0, images=0, errors=0)
+        while True:
+            claim = self.queue.claim(self.owner)
+            if claim is None:
+                if not wait or self.queue.unfinished() == 0:
+                    return stats
+                time.sleep(self.poll_interval)
+                continue
+
+            shard_id, input_path = claim
+            start = time.monotonic()
+            try:
+                images, errors = self.process(shard_id, input_path)
+            except LeaseLost:
+                print(f"Lost lease on shard {shard_id}; leaving it to its new owner")
+                continue
+            except ShardError as e:
+                print(f"Error processing shard {shard_id}: {e}")
+                self.queue.fail(shard_id, self.owner, e)
+                continue
+            except BaseException:
+                # Not the shard's fault (model, device, memory, disk, Ctrl-C):
+                # hand it back without using up an attempt and stop this worker
+                # rather than fail every shard it would claim next
+                self.queue.release(shard_id, self.owner)
+                raise
+
+            stats['shards'] += 1
+            stats['images'] += images
+            stats['errors'] += errors
+            elapsed = time.monotonic() - start
+            print(f"Shard {shard_id}: {images} images in {elapsed:.1f}s "
+                  f"({images / max(elapsed, 1e-9):.1f} img/s, {errors} errors)")
+
+    def process(self, shard_id, input_path):
+        """
+        Run inference on one shard and publish its output.
+
+        Returns:
+            Tuple of (images processed, images that failed)
+        """
+        try:
+            with open(os.path.join(self.work_dir, input_path)) as f:
+                paths = [line.strip() for line in f if line.strip()]
+        except OSError as e:
+            raise ShardError(f"Cannot read shard input {input_path}: {e}")
+
+        name = f"shard-{shard_id:06d}.jsonl"
+        output = os.path.join('outputs', name)
+        final_path = os.path.join(self.work_dir, output)
+        tmp_path = f"{final_path}.{self.owner}.part"
+
+        heartbeat = _Heartbeat(self.queue, shard_id, self.owner, self.heartbeat_interval)
+        heartbeat.start()
+        errors = 0
+        try:
+            with open(tmp_path, 'w') as out:
+                for start in range(0, len(paths), self.batch_size):
+                    if heartbeat.lost.is_set():
+                        raise LeaseLost(shard_id)
+                    for result in self.predict(paths[start:start + self.batch_size]):
+                        errors += 'error' in result
+                        out.write(json.dumps(result) + '\n')
+                out.flush()
+                os.fsync(out.fileno())
+            if heartbeat.lost.is_set() or not self.queue.renew(shard_id, self.owner):
+                raise LeaseLost(shard_id)
+            # Outputs are deterministic, so a worker that loses its lease after
+            # this point can only replace the file with identical contents
+            os.replace(tmp_path, final_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            heartbeat.stop()
+
+        if not self.queue.complete(shard_id, self.owner, output):
+            raise LeaseLost(shard_id)
+        return len(paths), errors
+
+
+def merge(queue, work_dir, output_path, partial=False, class_names=None):
+    """
+    Combine the shard outputs into one file, in input order.
+
+    Args:
+        queue: ShardQueue of the work folder
+        work_dir: Shared work folder
+        output_path: Destination; .jsonl keeps the raw records, anything
+            else is written as CSV with one probability column per class
+        partial: Merge the finished shards even if others are not done
+        class_names: Probability columns for CSV output (default: the classes
+            of the first record with probabilities, else CLASS_NAMES)
+
+    Returns:
+        Number of records written
+    """
+    shards = queue.shards()
+    missing = [shard['id'] for shard in shards if shard['status'] != DONE]
+    if missing and not partial:
+        raise RuntimeError(f"{len(missing)} of {len(shards)} shards are not done (first: {missing[0]})")
+
+    def records():
+        for shard in shards:
+            if shard['status'] != DONE:
+                continue
+            with open(os.path.join(work_dir, shard['output'])) as f:
+                for line in f:
+                    yield json.loads(line)
+
+    count = 0
+    tmp_path = f"{output_path}.part"
+    with open(tmp_path, 'w', newline='') as out:
+        if output_path.endswith('.jsonl'):
+            for record in records():
+                out.write(json.dumps(record) + '\n')
+                count += 1
+        else:
+            if class_names is None:
+                # Records of images that failed to decode have no probabilities
+                class_names = next(
+                    (list(record['probabilities']) for record in records() if record.get('probabilities')),
+                    CLASS_NAMES
+                )
+            writer = csv.writer(out)
+            writer.writerow(['path', 'prediction', 'confidence']
+                            + [f"{name}_probability" for name in class_names] + ['error'])
+            for record in records():
+                probabilities = record.get('probabilities', {})
+                writer.writerow([record['path'], record.get('prediction', ''), record.get('confidence', '')]
+                                + [probabilities.get(name, '') for name in class_names]
+                                + [record.get('error', '')])
+                count += 1
+    os.replace(tmp_path, output_path)
+    return count
+
+
+class LazyPredictor(object):
+    """
+    Loads the model on load() or first use, so workers that find no work
+    never load it.
+    """
+
+    def __init__(self, model_path, model_id, batch_size=16, optimize=True):
+        self.model_path = model_path
+        self.model_id = model_id
+        self.batch_size = batch_size
+        self.optimize = optimize
+        self._model = None
+
+    def load(self):
+        import torch
+        from transformers import CLIPImageProcessor
+        from model_utils import load_model
+
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self._model = load_model(self.model_path, device=self.device, model_id=self.model_id,
+                                 optimize=self.optimize)
+        self._processor = CLIPImageProcessor.from_pretrained(self.model_id)
+
+    def __call__(self, paths):
+        from model_utils import predict_images
+
+        if self._model is None:
+            self.load()
+        return predict_images(self._model, paths, self._processor, device=self.device,
+                              batch_size=self.batch_size)
+
+
+def print_status(queue):
+    counts = queue.counts()
+    total_shards = sum(c['shards'] for c in counts.values())
+    total_images = sum(c['images'] for c in counts.values())
+    print(f"{total_shards} shards, {total_images} images")
+    for status, c in counts.items():
+        print(f"  {status:<8} {c['shards']:>7} shards {c['images']:>10} images")
+
+    now = time.time()
+    for shard in queue.shards(LEASED):
+        remaining = shard['lease_expires'] - now
+        state = f"expires in {remaining:.0f}s" if remaining > 0 else f"expired {-remaining:.0f}s ago"
+        print(f"  shard {shard['id']} leased by {shard['owner']} (attempt {shard['attempts']}, {state})")
+    for shard in queue.shards(FAILED):
+        print(f"  shard {shard['id']} failed after {shard['attempts']} attempts: {shard['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded bulk inference over a shared work queue.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan_parser = subparsers.add_parser('plan', help="Split the input into shards and create the queue")
+    plan_parser.add_argument('--input', required=True, help="Folder of images or manifest (one path per line)")
+    plan_parser.add_argument('--shard-size', type=int, default=500, help="Images per shard")
+
+    work_parser = subparsers.add_parser('work', help="Claim and process shards until the queue is drained")
+    work_parser.add_argument('--model', default='model/lymphoma_clip_classifier.pth', help="Model checkpoint")
+    work_parser.add_argument('--model-id', default='openai/clip-vit-large-patch14', help="CLIP model id")
+    work_parser.add_argument('--batch-size', type=int, default=16)
+    work_parser.add_argument('--no-optimize', action='store_true', help="Skip inference optimizations")
+    work_parser.add_argument('--no-wait', action='store_true',
+                             help="Exit as soon as nothing is claimable instead of waiting on other leases")
+
+    merge_parser = subparsers.add_parser('merge', help="Combine shard outputs into one file")
+    merge_parser.add_argument('--output', required=True, help="Output file (.csv or .jsonl)")
+    merge_parser.add_argument('--partial', action='store_true', help="Merge even if some shards are not done")
+
+    subparsers.add_parser('status', help="Show queue progress")
+
+    retry_parser = subparsers.add_parser('retry', help="Put failed shards back in the queue")
+    retry_parser.add_argument('--failed', action='store_true', help="Requeue every failed shard")
+    retry_parser.add_argument('--shard', type=int, action='append', help="Requeue this failed shard (repeatable)")
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('--work', required=True, help="Shared work folder")
+        subparser.add_argument('--lease-seconds', type=float, default=300.0,
+                               help="Lease duration; a crashed worker's shard is reassigned after this")
+        subparser.add_argument('--max-attempts', type=int, default=3, help="Claims per shard before it fails")
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        queue = plan(args.input, args.work, shard_size=args.shard_size,
+                     lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+        print_status(queue)
+        return
+
+    queue_path = os.path.join(args.work, 'queue.sqlite')
+    if not os.path.exists(queue_path):
+        parser.error(f"No queue in {args.work}; run 'plan' first")
+    queue = ShardQueue(queue_path, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+
+    if args.command == 'work':
+        predictor = LazyPredictor(args.model, args.model_id, batch_size=args.batch_size,
+                                  optimize=not args.no_optimize)
+        worker = Worker(queue, args.work, predictor, batch_size=args.batch_size)
+        print(f"Worker {worker.owner} started")
+        start = time.monotonic()
+        try:
+            if queue.unfinished():
+                # Before claiming anything, so a broken node fails no shards
+                predictor.load()
+            stats = worker.run(wait=not args.no_wait)
+        except Exception as e:
+            print(f"Worker {worker.owner} stopped: {e}")
+            sys.exit(1)
+        print(f"Worker {worker.owner} finished in {time.monotonic() - start:.1f}s: {stats}")
+    elif args.command == 'retry':
+        if not args.failed and not args.shard:
+            parser.error("retry needs --failed or --shard")
+        count = queue.requeue(None if args.failed else args.shard)
+        print(f"Requeued {count} failed shards")
+    elif args.command == 'merge':
+        count = merge(queue, args.work, args.output, partial=args.partial)
+        print(f"Wrote {count} predictions to {args.output}")
+    else:
+        print_status(queue)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,557 @@
+"""
+Embedding index for similar-case retrieval.
+
+Stores the normalized CLIP embeddings produced by DeepCLIPClassifier.encode in
+a compact float16 or int8 matrix backed by a memory-mapped file, so worker
+processes share the pages and only touch what they scan. Search is a batched
+matrix product with top-k selection; once the archive is large, an optional
+coarse clustering (spherical k-means, inverted lists) limits each query to the
+rows of its nearest clusters.
+
+Layout of an index directory:
+    meta.json        dim, dtype, count, capacity, ... (written last, atomically)
+    ids.txt          one id per line, in row order
+    deleted.bin      int64 rows removed since the last compaction
+    vectors.bin      (capacity, dim) float16 or int8
+    scales.bin       (capacity,) float32 per-row scale (int8 only)
+    centroids.npy    (clusters, dim) float32 (after train())
+    assign.bin       (capacity,) int32 cluster of each row (after train())
+    writer.lock      held (flock) by the process that has the index open for writing
+
+One process writes (the build command or the indexer); opening a second
+writer raises IndexLocked. Any number of processes can read and pick up
+appended or removed rows with refresh().
+Removed rows are tombstoned and skipped by search until compact() rewrites
+the files without them.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows: single-writer is then up to the caller
+    fcntl = None
+
+_DTYPES = {'float16': np.float16, 'int8': np.int8}
+
+
+class IndexLocked(RuntimeError):
+    """Another process (or EmbeddingIndex) already has the index open for writing."""
+    pass
+
+
+class EmbeddingIndex(object):
+    """
+    Memory-mapped embedding matrix with batched top-k cosine search.
+
+    Args:
+        path: Index directory
+        dim: Embedding dimension (required when creating a new index)
+        dtype: 'float16' or 'int8' storage (new indexes only)
+        readonly: Open an existing index for searching only
+
+    Raises:
+        IndexLocked: If the index is opened for writing while another writer
+            has it open
+    """
+
+    def __init__(self, path, dim=None, dtype='float16', readonly=False):
+        self.path = path
+        self.readonly = readonly
+        meta_path = os.path.join(path, 'meta.json')
+        self._lock_file = None
+        if not readonly:
+            self._lock_writer()
+
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        else:
+            if readonly:
+                raise FileNotFoundError(f"No embedding index at {path}")
+            if dim is None:
+                raise ValueError("dim is required to create an embedding index")
+            if dtype not in _DTYPES:
+                raise ValueError(f"dtype must be one of {sorted(_DTYPES)}")
+            meta = {'dim': int(dim), 'dtype': dtype, 'count': 0, 'capacity': 0}
+            open(os.path.join(path, 'ids.txt'), 'w').close()
+
+        self.dim = meta['dim']
+        self.dtype = meta['dtype']
+        self.count = 0
+        self.capacity = meta['capacity']
+        self.ids = []
+        self.generation = 0
+        self._ids_offset = 0
+        self._meta_mtime = None
+        self._rows_by_id = {}
+        self._live = np.ones(0, dtype=bool)
+        self._deleted = 0
+
+        self.centroids = None
+        self._trained_stamp = None
+        self._lists = None
+        self._assign = None
+        self._vectors = None
+        self._scales = None
+
+        if not os.path.exists(meta_path):
+            self._write_meta()
+        self.refresh(force=True)
+
+    def _lock_writer(self):
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = open(os.path.join(self.path, 'writer.lock'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                raise IndexLocked(f"Embedding index at {self.path} is already open for writing")
+        self._lock_file = lock_file
+
+    def close(self):
+        """Release the writer lock. The index is still searchable afterwards."""
+        if self._lock_file is not None:
+            self._flush_maps()
+            self._lock_file.close()
+            self._lock_file = None
+            self.readonly = True
+
+    def __len__(self):
+        """Number of live (not removed) embeddings."""
+        return self.count - self._deleted
+
+    def __contains__(self, ref_id):
+        return ref_id in self._rows_by_id
+
+    def refresh(self, force=False):
+        """
+        Pick up rows appended by the writer since the last call.
+
+        Returns True if the index changed.
+        """
+        meta_path = os.path.join(self.path, 'meta.json')
+        mtime = os.path.getmtime(meta_path)
+        if not force and mtime == self._meta_mtime:
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        self._meta_mtime = mtime
+
+        if meta.get('generation', 0) != self.generation:
+            # The writer compacted the index: reload everything
+            self.generation = meta.get('generation', 0)
+            self.ids = []
+            self._ids_offset = 0
+            self._rows_by_id = {}
+            self._live = np.ones(0, dtype=bool)
+            self._deleted = 0
+            self.count = 0
+            self._trained_stamp = None
+            self._vectors = None
+
+        if meta['capacity'] != self.capacity or self._vectors is None:
+            self.capacity = meta['capacity']
+            self._map_rows()
+
+        with open(os.path.join(self.path, 'ids.txt')) as f:
+            f.seek(self._ids_offset)
+            for row in range(len(self.ids), meta['count']):
+                ref_id = f.readline().rstrip('\n')
+                self.ids.append(ref_id)
+                self._rows_by_id[ref_id] = row
+            self._ids_offset = f.tell()
+        self.count = meta['count']
+        self._live = np.concatenate([self._live, np.ones(self.count - len(self._live), dtype=bool)])
+
+        deleted = meta.get('deleted', 0)
+        if deleted > self._deleted:
+            rows = np.fromfile(os.path.join(self.path, 'deleted.bin'), dtype=np.int64,
+                               count=deleted - self._deleted, offset=self._deleted * 8)
+            self._tombstone(rows)
+            self._deleted = deleted
+
+        if meta.get('trained') is None:
+            self.centroids = None
+            self._lists = None
+        else:
+            if meta['trained'] != self._trained_stamp:
+                self.centroids = np.load(os.path.join(self.path, 'centroids.npy'))
+                self._trained_stamp = meta['trained']
+            if self._assign is None:
+                self._map_rows()
+            self._build_lists()
+        return True
+
+    def add(self, ids, vectors):
+        """
+        Append embeddings.
+
+        Args:
+            ids: Sequence of string ids (e.g. reference image paths)
+            vectors: Array-like of shape (n, dim), L2-normalized
+        """
+        if self.readonly:
+            raise RuntimeError("Embedding index was opened read-only")
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        ids = [str(i) for i in ids]
+        if len(ids) != len(vectors):
+            raise ValueError("ids and vectors must have the same length")
+        if any('\n' in i for i in ids):
+            raise ValueError("ids must not contain newlines")
+        if not ids:
+            return
+
+        # Re-adding an id replaces its previous embedding
+        self.remove([i for i in ids if i in self._rows_by_id], write_meta=False)
+
+        start, end = self.count, self.count + len(ids)
+        if end > self.capacity:
+            self._grow(end)
+
+        stored, scales = self._quantize(vectors)
+        self._vectors[start:end] = stored
+        if scales is not None:
+            self._scales[start:end] = scales
+        if self.centroids is not None:
+            assign = self._nearest_centroids(vectors, 1)[:, 0]
+            self._assign[start:end] = assign
+            rows = np.arange(start, end)
+            for cluster in np.unique(assign):
+                self._lists[cluster] = np.concatenate([self._lists[cluster], rows[assign == cluster]])
+        self._flush_maps()
+
+        with open(os.path.join(self.path, 'ids.txt'), 'a') as f:
+            f.write(''.join(i + '\n' for i in ids))
+        for row, ref_id in enumerate(ids, start):
+            self._rows_by_id[ref_id] = row
+        self.ids.extend(ids)
+        self.count = end
+        self._live = np.concatenate([self._live, np.ones(len(ids), dtype=bool)])
+        self._write_meta()
+
+    def remove(self, ids, write_meta=True):
+        """
+        Remove embeddings by id. Unknown ids are ignored.
+
+        Returns:
+            Number of embeddings removed
+        """
+        if self.readonly:
+            raise RuntimeError("Embedding index was opened read-only")
+        rows = np.array([self._rows_by_id[i] for i in set(ids) if i in self._rows_by_id], dtype=np.int64)
+        if len(rows) == 0:
+            return 0
+        with open(os.path.join(self.path, 'deleted.bin'), 'ab') as f:
+            f.write(rows.tobytes())
+        self._tombstone(rows)
+        self._deleted += len(rows)
+        if write_meta:
+            self._write_meta()
+        return len(rows)
+
+    def get(self, ids):
+        """
+        Stored embeddings for the given ids.
+
+        Raises:
+            KeyError: If an id is not in the index
+        """
+        rows = np.array([self._rows_by_id[i] for i in ids], dtype=np.int64)
+        if len(rows) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return self.vectors(rows)
+
+    def compact(self, chunk_rows=65536):
+        """
+        Rewrite the index without removed rows.
+
+        Readers notice the new generation on their next refresh() and reload.
+        """
+        if self.readonly:
+            raise RuntimeError("Embedding index was opened read-only")
+        live_rows = np.flatnonzero(self._live[:self.count])
+        names = ['vectors.bin'] + (['scales.bin'] if self._scales is not None else []) \
+            + (['assign.bin'] if self._assign is not None else [])
+        sources = {'vectors.bin': self._vectors, 'scales.bin': self._scales, 'assign.bin': self._assign}
+
+        for name in names:
+            with open(os.path.join(self.path, name + '.compact'), 'wb') as out:
+                for start in range(0, len(live_rows), chunk_rows):
+                    out.write(np.ascontiguousarray(sources[name][live_rows[start:start + chunk_rows]]).tobytes())
+        ids = [self.ids[r] for r in live_rows]
+        with open(os.path.join(self.path, 'ids.txt.compact'), 'w') as f:
+            f.write(''.join(i + '\n' for i in ids))
+
+        for name in names + ['ids.txt']:
+            os.replace(os.path.join(self.path, name + '.compact'), os.path.join(self.path, name))
+        open(os.path.join(self.path, 'deleted.bin'), 'wb').close()
+
+        self.generation += 1
+        self.ids = ids
+        self._rows_by_id = {ref_id: row for row, ref_id in enumerate(ids)}
+        self._ids_offset = os.path.getsize(os.path.join(self.path, 'ids.txt'))
+        self.count = self.capacity = len(ids)
+        self._live = np.ones(self.count, dtype=bool)
+        self._deleted = 0
+        self._map_rows()
+        if self.centroids is not None:
+            self._build_lists()
+        self._write_meta()
+
+    def _tombstone(self, rows):
+        self._live[rows] = False
+        for row in rows:
+            ref_id = self.ids[row]
+            if self._rows_by_id.get(ref_id) == row:
+                del self._rows_by_id[ref_id]
+        if self._lists is not None:
+            self._build_lists()
+
+    def vectors(self, rows=None):
+        """Decoded float32 embeddings for the given rows (all rows by default)."""
+        if rows is None:
+            rows = slice(0, self.count)
+        stored = np.asarray(self._vectors[rows], dtype=np.float32)
+        if self._scales is not None:
+            stored *= np.asarray(self._scales[rows], dtype=np.float32)[:, None]
+        return stored
+
+    def search(self, queries, k=5, nprobe=8, chunk_rows=65536):
+        """
+        Batched top-k cosine search.
+
+        Args:
+            queries: Array-like of shape (q, dim) or (dim,), L2-normalized
+            k: Number of neighbours per query
+            nprobe: Clusters scanned per query when the index is trained
+            chunk_rows: Rows scored at a time in exhaustive search
+
+        Returns:
+            List (one entry per query) of [(id, score), ...] best first
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if len(self) == 0 or k <= 0:
+            return [[] for _ in range(len(queries))]
+
+        if self.centroids is not None and nprobe < len(self.centroids):
+            return self._search_clusters(queries, k, nprobe)
+
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, self.count, chunk_rows):
+            end = min(start + chunk_rows, self.count)
+            scores = queries @ self.vectors(slice(start, end)).T
+            scores[:, ~self._live[start:end]] = -np.inf
+            rows = np.broadcast_to(np.arange(start, end), scores.shape)
+            best_scores, best_rows = _merge_topk(best_scores, best_rows, scores, rows, k)
+        return [self._results(r, s) for r, s in zip(best_rows, best_scores)]
+
+    def train(self, n_clusters=None, iterations=10, sample_size=50000, seed=0):
+        """
+        Fit the coarse clustering (spherical k-means) and assign every row.
+
+        Rows added later are assigned to their nearest centroid on insert.
+        """
+        if self.readonly:
+            raise RuntimeError("Embedding index was opened read-only")
+        live_rows = np.flatnonzero(self._live[:self.count])
+        if n_clusters is None:
+            n_clusters = max(1, int(4 * np.sqrt(len(live_rows))))
+        n_clusters = min(n_clusters, len(live_rows))
+        if n_clusters < 1:
+            raise ValueError("Cannot train an empty embedding index")
+
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(live_rows, size=min(sample_size, len(live_rows)), replace=False))
+        sample = self.vectors(sample_rows)
+        centroids = sample[rng.choice(len(sample), size=n_clusters, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty clusters keep their previous centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        self.centroids = centroids.astype(np.float32)
+        np.save(os.path.join(self.path, 'centroids.npy'), self.centroids)
+        self._map_rows()
+        for start in range(0, self.count, 65536):
+            end = min(start + 65536, self.count)
+            self._assign[start:end] = self._nearest_centroids(self.vectors(slice(start, end)), 1)[:, 0]
+        self._flush_maps()
+        self._trained_stamp = int(time.time() * 1000)
+        self._build_lists()
+        self._write_meta()
+
+    def _search_clusters(self, queries, k, nprobe):
+        # Each query's candidates are the rows of its probed clusters, laid
+        # out side by side in one padded (queries, candidates) score matrix.
+        # Every probed cluster is decoded once and scored against all the
+        # queries that probe it, then top k is selected for all rows at once.
+        probes = self._nearest_centroids(queries, nprobe)
+        lengths = np.array([len(rows) for rows in self._lists])[probes]
+        starts = np.cumsum(lengths, axis=1) - lengths
+        width = lengths.sum(axis=1).max()
+        if width == 0:
+            return [[] for _ in range(len(queries))]
+        scores = np.full((len(queries), width), -np.inf, dtype=np.float32)
+        rows = np.zeros((len(queries), width), dtype=np.int64)
+
+        flat = probes.ravel()
+        order = np.argsort(flat, kind='stable')
+        clusters, first = np.unique(flat[order], return_index=True)
+        for cluster, slots in zip(clusters, np.split(order, first[1:])):
+            cluster_rows = self._lists[cluster]
+            if len(cluster_rows) == 0:
+                continue
+            members, probe = np.divmod(slots, probes.shape[1])
+            columns = starts[members, probe][:, None] + np.arange(len(cluster_rows))
+            scores[members[:, None], columns] = queries[members] @ self.vectors(cluster_rows).T
+            rows[members[:, None], columns] = cluster_rows
+
+        none = np.zeros((len(queries), 0))
+        scores, rows = _merge_topk(none.astype(np.float32), none.astype(np.int64), scores, rows, k)
+        return [self._results(r, s) for r, s in zip(rows, scores)]
+
+    def _nearest_centroids(self, vectors, n):
+        scores = vectors @ self.centroids.T
+        n = min(n, scores.shape[1])
+        top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        return np.take_along_axis(top, order, axis=1)
+
+    def _build_lists(self):
+        live_rows = np.flatnonzero(self._live[:self.count])
+        assign = np.asarray(self._assign[:self.count])[live_rows]
+        order = np.argsort(assign, kind='stable')
+        bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+        self._lists = [live_rows[order[bounds[c]:bounds[c + 1]]] for c in range(len(self.centroids))]
+
+    def _results(self, rows, scores):
+        return [(self.ids[r], float(s)) for r, s in zip(rows, scores) if np.isfinite(s)]
+
+    def _quantize(self, vectors):
+        if self.dtype == 'int8':
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            stored = np.round(vectors / scales[:, None]).astype(np.int8)
+            return stored, scales.astype(np.float32)
+        return vectors.astype(np.float16), None
+
+    def _grow(self, needed):
+        capacity = max(1024, self.capacity)
+        while capacity < needed:
+            capacity *= 2
+        item = np.dtype(_DTYPES[self.dtype]).itemsize
+        self._resize('vectors.bin', capacity * self.dim * item)
+        if self.dtype == 'int8':
+            self._resize('scales.bin', capacity * 4)
+        if self.centroids is not None:
+            self._resize('assign.bin', capacity * 4)
+        self.capacity = capacity
+        self._map_rows()
+
+    def _resize(self, name, size):
+        with open(os.path.join(self.path, name), 'ab') as f:
+            f.truncate(size)
+
+    def _map_rows(self):
+        mode = 'r' if self.readonly else 'r+'
+        shape = (self.capacity, self.dim)
+        self._vectors = self._memmap('vectors.bin', _DTYPES[self.dtype], shape, mode)
+        self._scales = None
+        if self.dtype == 'int8':
+            self._scales = self._memmap('scales.bin', np.float32, (self.capacity,), mode)
+        self._assign = None
+        if self.centroids is not None:
+            if not self.readonly:
+                self._resize('assign.bin', self.capacity * 4)
+            self._assign = self._memmap('assign.bin', np.int32, (self.capacity,), mode)
+
+    def _memmap(self, name, dtype, shape, mode):
+        if self.capacity == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode=mode, shape=shape)
+
+    def _flush_maps(self):
+        for array in (self._vectors, self._scales, self._assign):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def _write_meta(self):
+        meta = {
+            'dim': self.dim,
+            'dtype': self.dtype,
+            'count': self.count,
+            'capacity': self.capacity,
+            'trained': self._trained_stamp,
+            'deleted': self._deleted,
+            'generation': self.generation,
+        }
+        tmp_path = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(self.path, 'meta.json'))
+        self._meta_mtime = os.path.getmtime(os.path.join(self.path, 'meta.json'))
+
+
+def _merge_topk(best_scores, best_rows, scores, rows, k):
+    scores = np.concatenate([best_scores, scores], axis=1)
+    rows = np.concatenate([best_rows, rows], axis=1)
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        rows = np.take_along_axis(rows, top, axis=1)
+    order = np.argsort(-scores, axis=1)
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an embedding index from a folder of reference images.")
+    parser.add_argument('--images', required=True, help="Folder of reference images (searched recursively)")
+    parser.add_argument('--index', default='model/embedding_index', help="Index directory")
+    parser.add_argument('--model', default='model/lymphoma_clip_classifier.pth', help="Model checkpoint")
+    parser.add_argument('--model-id', default='openai/clip-vit-large-patch14', help="CLIP model id")
+    parser.add_argument('--dtype', choices=sorted(_DTYPES), default='float16')
+    parser.add_argument('--clusters', type=int, default=0,
+                        help="Coarse clusters for sub-linear search (0 = exhaustive, -1 = automatic)")
+    parser.add_argument('--batch-size', type=int, default=16)
+    args = parser.parse_args()
+
+    import torch
+    from transformers import CLIPImageProcessor
+    from model_utils import encode_images, is_valid_image, load_model
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = load_model(args.model, device=device, model_id=args.model_id)
+    processor = CLIPImageProcessor.from_pretrained(args.model_id)
+
+    paths = []
+    for dirpath, _, filenames in os.walk(args.images):
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames) if is_valid_image(f))
+    paths.sort()
+
+    index = EmbeddingIndex(args.index, dim=model.clip_model.config.projection_dim, dtype=args.dtype)
+    paths = [p for p in paths if os.path.relpath(p, args.images) not in index]
+    print(f"Encoding {len(paths)} new images ({len(index)} already indexed)...")
+
+    for start in range(0, len(paths), args.batch_size):
+        batch = paths[start:start + args.batch_size]
+        features = encode_images(model, batch, processor, device=device, batch_size=args.batch_size)
+        index.add([os.path.relpath(p, args.images) for p in batch], features.numpy())
+
+    if args.clusters:
+        index.train(n_clusters=None if args.clusters < 0 else args.clusters)
+    print(f"Embedding index at {args.index} has {len(index)} entries")
+
+
+if __name__ == '__main__':
+    main()
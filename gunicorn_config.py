@@ -1,5 +1,6 @@
 # Gunicorn configuration file
 import multiprocessing
+import os
 
 # Server socket
 bind = "0.0.0.0:8000"
@@ -7,7 +8,17 @@ backlog = 2048
 
 # Worker processes
 workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
+# Threaded workers so each process can queue requests in its admission
+# controller (see admission.py) instead of blocking on the socket backlog.
+# Every request waiting in the controller holds a thread, so a worker needs
+# max_concurrent + max_queue threads before the controller can ever fill up
+# and answer 429, plus spare threads to send those rejections and to serve
+# static files and thumbnails. Fewer threads would leave the excess waiting
+# in gunicorn's own unbounded FIFO instead.
+worker_class = "gthread"
+_admission_threads = (int(os.getenv("ADMISSION_MAX_CONCURRENT", 1))
+                      + int(os.getenv("ADMISSION_MAX_QUEUE", 8)))
+threads = max(int(os.getenv("GUNICORN_THREADS", 0)), _admission_threads + 4)
 worker_connections = 1000
 timeout = 120
 keepalive = 5
@@ -0,0 +1,361 @@
+"""
+Incremental embedding indexer.
+
+Keeps an EmbeddingIndex in sync with a folder of images (e.g. the reference
+archive). A SQLite manifest records (path, mtime, size, content hash) for
+every indexed file, so each sync only:
+
+    - stats every file (cheap) and hashes the ones whose mtime/size changed,
+    - re-uses the stored embedding when a changed or new file has content
+      that is already indexed (touched, copied or renamed files),
+    - encodes the remaining new or modified files in batches,
+    - drops files that were deleted.
+
+Files that cannot be read or encoded are remembered with their mtime/size
+and skipped until they change, so a bad file costs nothing on later syncs.
+
+Encoding and hashing work is therefore proportional to what changed. The
+scan itself still stats every file, so each sync costs one walk of the whole
+archive even when nothing changed.
+Ids in the index are paths relative to the root folder, so the first path
+component is the class for folders laid out as <root>/<class>/<image>.
+
+One-shot:
+    python indexer.py --root /data/reference --index model/embedding_index
+Keep watching for changes (full scan every --interval seconds, default 300):
+    python indexer.py --root /data/reference --index model/embedding_index --watch
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+
+from embedding_index import EmbeddingIndex
+from model_utils import is_valid_image
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Indexer(object):
+    """
+    Syncs the embeddings of the images under root into an EmbeddingIndex.
+
+    Args:
+        root: Folder of images (searched recursively)
+        index_path: EmbeddingIndex directory; the manifest is stored inside it
+        encode: Callable taking a list of image paths and returning an
+            (n, dim) array of normalized embeddings
+        dim: Embedding dimension (needed only to create a new index)
+        batch_size: Images encoded per call to encode
+        compact_ratio: Compact the index once this share of its rows is removed
+    """
+
+    def __init__(self, root, index_path, encode, dim=None, batch_size=16, compact_ratio=0.25):
+        self.root = root
+        self.index_path = index_path
+        self.encode = encode
+        self.dim = dim
+        self.batch_size = batch_size
+        self.compact_ratio = compact_ratio
+        self._index = None
+
+        os.makedirs(index_path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(index_path, 'manifest.sqlite'))
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS failures (
+                path TEXT PRIMARY KEY,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                error TEXT
+            )
+        """)
+        self.db.commit()
+
+    @property
+    def index(self):
+        # Created lazily so a sync with nothing to encode never needs dim
+        if self._index is None:
+            if os.path.exists(os.path.join(self.index_path, 'meta.json')):
+                self._index = EmbeddingIndex(self.index_path)
+            else:
+                dim = self.dim if self.dim is not None else getattr(self.encode, 'dim', None)
+                self._index = EmbeddingIndex(self.index_path, dim=dim)
+        return self._index
+
+    def scan(self):
+        """Current image files under root: {relative path: (mtime, size)}."""
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # Skip hidden/system folders such as .ipynb_checkpoints
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if not is_valid_image(filename):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files[os.path.relpath(path, self.root)] = (st.st_mtime, st.st_size)
+        return files
+
+    def sync(self):
+        """
+        Bring the index up to date with the folder.
+
+        Returns:
+            Dict of counts: added, updated, removed, reused, unchanged, failed,
+            skipped (files that failed before and have not changed since)
+        """
+        stats = dict(added=0, updated=0, removed=0, reused=0, unchanged=0, failed=0, skipped=0)
+        current = self.scan()
+        known = {
+            path: (mtime, size, sha)
+            for path, mtime, size, sha in self.db.execute("SELECT path, mtime, size, sha256 FROM files")
+        }
+        failures = {
+            path: (mtime, size)
+            for path, mtime, size in self.db.execute("SELECT path, mtime, size FROM failures")
+        }
+
+        # New or modified files; only these are hashed
+        pending = []
+        for path, (mtime, size) in sorted(current.items()):
+            previous = known.get(path)
+            if previous is not None and previous[:2] == (mtime, size):
+                stats['unchanged'] += 1
+                continue
+            if failures.get(path) == (mtime, size):
+                stats['skipped'] += 1
+                continue
+            try:
+                sha = file_sha256(os.path.join(self.root, path))
+            except OSError as e:
+                print(f"Error reading {path}: {e}")
+                self._record_failure(path, mtime, size, e)
+                stats['failed'] += 1
+                continue
+            if previous is not None and previous[2] == sha:
+                # Touched but not modified
+                self._record([(path, mtime, size, sha)])
+                stats['unchanged'] += 1
+                continue
+            pending.append((path, mtime, size, sha, previous is not None))
+
+        # Content that is already indexed under another path is copied, not re-encoded
+        to_encode = []
+        for path, mtime, size, sha, existed in pending:
+            source = self._indexed_path_for(sha, exclude=path)
+            if source is not None:
+                self.index.add([path], self.index.get([source]))
+                self._record([(path, mtime, size, sha)])
+                stats['reused'] += 1
+                stats['updated' if existed else 'added'] += 1
+            else:
+                to_encode.append((path, mtime, size, sha, existed))
+
+        # Deleted files (after re-use, so renamed files keep their embedding)
+        removed = [path for path in known if path not in current]
+        if removed:
+            self.index.remove(removed)
+            self.db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in removed])
+            self.db.commit()
+            stats['removed'] = len(removed)
+        gone = [path for path in failures if path not in current]
+        if gone:
+            self.db.executemany("DELETE FROM failures WHERE path = ?", [(p,) for p in gone])
+            self.db.commit()
+
+        for start in range(0, len(to_encode), self.batch_size):
+            batch = to_encode[start:start + self.batch_size]
+            try:
+                vectors = self.encode([os.path.join(self.root, entry[0]) for entry in batch])
+            except Exception as e:
+                # Fall back to one at a time so one bad image doesn't block the batch
+                print(f"Error encoding batch: {e}")
+                stats['failed'] += self._encode_individually(batch, stats)
+                continue
+            self.index.add([entry[0] for entry in batch], vectors)
+            self._record([entry[:4] for entry in batch])
+            for entry in batch:
+                stats['updated' if entry[4] else 'added'] += 1
+
+        if self._index is not None and self._index.count:
+            if self._index.count - len(self._index) > self.compact_ratio * self._index.count:
+                self._index.compact()
+        return stats
+
+    def watch(self, interval=300.0):
+        """
+        Sync forever, polling the folder every interval seconds.
+
+        Every poll walks and stats the whole archive, so keep the interval well
+        above the time a sync with no changes takes; a warning is printed when
+        scanning uses more than a tenth of the interval.
+        """
+        while True:
+            start = time.monotonic()
+            try:
+                stats = self.sync()
+            except Exception as e:
+                # Disk or database trouble: keep the daemon alive and retry next poll
+                print(f"Error syncing {self.root}: {e}")
+            else:
+                elapsed = time.monotonic() - start
+                changed = {k: v for k, v in stats.items() if v and k not in ('unchanged', 'skipped')}
+                if changed:
+                    print(f"Synced in {elapsed:.1f}s: {changed}")
+                elif elapsed > 0.1 * interval:
+                    print(f"Scanning {stats['unchanged'] + stats['skipped']} files took {elapsed:.1f}s; "
+                          f"consider a longer --interval than {interval:g}s")
+            time.sleep(interval)
+
+    def _encode_individually(self, batch, stats):
+        failed = 0
+        for path, mtime, size, sha, existed in batch:
+            try:
+                vectors = self.encode([os.path.join(self.root, path)])
+            except Exception as e:
+                print(f"Error encoding {path}: {e}")
+                self._record_failure(path, mtime, size, e)
+                failed += 1
+                continue
+            self.index.add([path], vectors)
+            self._record([(path, mtime, size, sha)])
+            stats['updated' if existed else 'added'] += 1
+        return failed
+
+    def _indexed_path_for(self, sha, exclude):
+        row = self.db.execute(
+            "SELECT path FROM files WHERE sha256 = ? AND path != ? LIMIT 1", (sha, exclude)
+        ).fetchone()
+        if row is not None and row[0] in self.index:
+            return row[0]
+        return None
+
+    def _record(self, entries):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO files (path, mtime, size, sha256) VALUES (?, ?, ?, ?)", entries
+        )
+        self.db.executemany("DELETE FROM failures WHERE path = ?", [(entry[0],) for entry in entries])
+        self.db.commit()
+
+    def _record_failure(self, path, mtime, size, error):
+        # A modified file that fails to encode must not keep its old embedding
+        if self.db.execute("SELECT 1 FROM files WHERE path = ?", (path,)).fetchone():
+            if path in self.index:
+                self.index.remove([path])
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+        self.db.execute(
+            "INSERT OR REPLACE INTO failures (path, mtime, size, error) VALUES (?, ?, ?, ?)",
+            (path, mtime, size, str(error))
+        )
+        self.db.commit()
+
+
+def class_prototypes(index):
+    """
+    Mean normalized embedding per class, where the class is the first path
+    component of each id (<class>/<image>). Same result as the notebook's
+    build_class_prototypes, without re-encoding any image.
+
+    Returns:
+        Dict of class name to prototype tensor
+    """
+    import torch
+
+    groups = {}
+    for ref_id in index.ids:
+        if ref_id in index and os.sep in ref_id:
+            groups.setdefault(ref_id.split(os.sep, 1)[0], []).append(ref_id)
+
+    prototypes = {}
+    for class_name, ids in sorted(groups.items()):
+        prototype = torch.from_numpy(index.get(sorted(set(ids)))).mean(dim=0)
+        prototypes[class_name] = prototype / prototype.norm()
+    return prototypes
+
+
+class LazyEncoder(object):
+    """Loads the model on first use, so syncs without changes never load it."""
+
+    def __init__(self, model_path, model_id, batch_size=16):
+        self.model_path = model_path
+        self.model_id = model_id
+        self.batch_size = batch_size
+        self._model = None
+
+    def _load(self):
+        import torch
+        from transformers import CLIPImageProcessor
+        from model_utils import load_model
+
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self._model = load_model(self.model_path, device=self.device, model_id=self.model_id)
+        self._processor = CLIPImageProcessor.from_pretrained(self.model_id)
+
+    @property
+    def dim(self):
+        if self._model is None:
+            self._load()
+        return self._model.clip_model.config.projection_dim
+
+    def __call__(self, paths):
+        from model_utils import encode_images
+
+        if self._model is None:
+            self._load()
+        return encode_images(self._model, paths, self._processor, device=self.device,
+                             batch_size=self.batch_size).numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incrementally index image embeddings.")
+    parser.add_argument('--root', required=True, help="Folder of images to index")
+    parser.add_argument('--index', default='model/embedding_index', help="Index directory")
+    parser.add_argument('--model', default='model/lymphoma_clip_classifier.pth', help="Model checkpoint")
+    parser.add_argument('--model-id', default='openai/clip-vit-large-patch14', help="CLIP model id")
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--watch', action='store_true', help="Keep running and sync on changes")
+    parser.add_argument('--interval', type=float, default=300.0,
+                        help="Seconds between syncs with --watch (each one walks the whole archive)")
+    parser.add_argument('--prototypes', help="Also write class prototypes (torch .pt) to this path")
+    args = parser.parse_args()
+
+    encoder = LazyEncoder(args.model, args.model_id, batch_size=args.batch_size)
+    indexer = Indexer(args.root, args.index, encoder, batch_size=args.batch_size)
+
+    if args.watch:
+        indexer.watch(interval=args.interval)
+        return
+
+    start = time.monotonic()
+    stats = indexer.sync()
+    print(f"Synced {args.root} in {time.monotonic() - start:.1f}s: {stats}")
+
+    if args.prototypes:
+        import torch
+        prototypes = class_prototypes(indexer.index)
+        torch.save(prototypes, args.prototypes)
+        for class_name in prototypes:
+            print(f"Built prototype for {class_name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,441 @@
+"""
+HTTP load generator for the Flask app.
+
+Replays sample images against /upload (or /upload/batch) and reports
+throughput, latency percentiles and error rate. The server's Server-Timing
+header is used to split each request into multipart parsing, upload storage,
+admission queueing and inference; whatever remains is HTTP/WSGI overhead.
+
+Target a running server (e.g. gunicorn):
+    python loadtest.py --url http://127.0.0.1:8000 --concurrency 8 --duration 30
+
+Or start the app in-process:
+    python loadtest.py --serve dummy --rate 50 --duration 20
+    python loadtest.py --serve real --concurrency 4 --requests 200
+
+`--serve real` uses a tiny randomly initialised CLIP model, so the REAL code
+path (decode, preprocessing, encoder, head) is exercised without downloading
+ViT-L; comparing it with `--serve dummy` isolates the cost of inference.
+
+`--concurrency` alone runs a closed loop (each worker sends its next request
+as soon as the previous one returns). `--rate` switches to open-loop Poisson
+arrivals, with latency measured from the scheduled arrival time so queueing
+delay is not hidden when the server falls behind.
+"""
+import argparse
+import http.client
+import json
+import logging
+import mimetypes
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+SERVER_PHASES = ('parse', 'store', 'queue', 'infer')
+# Reported inside 'infer' (REAL mode only), so kept out of the breakdown sum
+DECODE_PHASES = ('decode', 'decode_saved')
+
+# Extensions the app accepts (app.config['ALLOWED_EXTENSIONS']). Checked
+# locally so the client doesn't need torch/transformers installed.
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'}
+
+
+def is_image(filename):
+    return os.path.splitext(filename.lower())[1] in IMAGE_EXTENSIONS
+
+
+def collect_images(paths):
+    """Image files from a list of files and directories (searched recursively)."""
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                images.extend(os.path.join(dirpath, f) for f in sorted(filenames) if is_image(f))
+        elif is_image(path):
+            images.append(path)
+    return images
+
+
+def encode_multipart(field, files):
+    """
+    Build a multipart/form-data body.
+
+    Args:
+        field: Form field name ('file' or 'files')
+        files: List of (filename, bytes)
+
+    Returns:
+        (body bytes, content type header)
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for filename, data in files:
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        parts.append(
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8')
+        )
+        parts.append(data)
+        parts.append(b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def parse_server_timing(header):
+    """Server-Timing header to {phase: milliseconds}."""
+    timings = {}
+    for entry in (header or '').split(','):
+        name, _, params = entry.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                try:
+                    timings[name] = float(value)
+                except ValueError:
+                    pass
+    return timings
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class LoadGenerator(object):
+    """
+    Sends upload requests from a pool of worker threads and records results.
+
+    Args:
+        url: Base URL of the server
+        images: List of (filename, bytes) to replay
+        endpoint: 'upload' or 'batch'
+        batch_size: Images per request for the batch endpoint
+        concurrency: Worker threads (maximum requests in flight)
+        rate: Open-loop arrival rate in requests/second, or None for closed loop
+        duration: Seconds to run (used when requests is None)
+        requests: Total requests to send
+        timeout: Per-request socket timeout in seconds
+        deadline_ms: Optional X-Deadline-Ms sent with every request
+    """
+
+    def __init__(self, url, images, endpoint='upload', batch_size=4, concurrency=4, rate=None,
+                 duration=10.0, requests=None, timeout=130.0, deadline_ms=None):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme or 'http'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.prefix = parts.path.rstrip('/')
+        self.images = images
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.requests = requests
+        self.timeout = timeout
+        self.deadline_ms = deadline_ms
+
+        self.results = []
+        self._lock = threading.Lock()
+        self._sent = 0
+
+    def run(self):
+        """Run the load test and return the summary dict."""
+        self._start = time.perf_counter()
+        self._stop_at = None if self.requests else self._start + self.duration
+        work = queue.Queue() if self.rate else None
+
+        workers = [threading.Thread(target=self._worker, args=(i, work), daemon=True)
+                   for i in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+
+        if work is not None:
+            self._schedule_arrivals(work)
+            for _ in workers:
+                work.put(None)
+
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - self._start
+        return summarize(self.results, elapsed)
+
+    def _schedule_arrivals(self, work):
+        next_arrival = self._start
+        while self._take_ticket():
+            next_arrival += random.expovariate(self.rate)
+            if self._stop_at is not None and next_arrival >= self._stop_at:
+                break
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            work.put(next_arrival)
+
+    def _take_ticket(self):
+        with self._lock:
+            if self.requests is not None and self._sent >= self.requests:
+                return False
+            self._sent += 1
+            return True
+
+    def _worker(self, index, work):
+        connection = None
+        rng = random.Random(index)
+        while True:
+            if work is not None:
+                scheduled = work.get()
+                if scheduled is None:
+                    break
+            else:
+                if self._stop_at is not None and time.perf_counter() >= self._stop_at:
+                    break
+                if not self._take_ticket():
+                    break
+                scheduled = time.perf_counter()
+
+            if connection is None:
+                connection = self._connect()
+            result, connection = self._send(connection, rng, scheduled)
+            with self._lock:
+                self.results.append(result)
+
+        if connection is not None:
+            connection.close()
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _send(self, connection, rng, scheduled):
+        if self.endpoint == 'batch':
+            path, field = '/upload/batch', 'files'
+            files = [rng.choice(self.images) for _ in range(self.batch_size)]
+        else:
+            path, field = '/upload', 'file'
+            files = [rng.choice(self.images)]
+        body, content_type = encode_multipart(field, files)
+        headers = {'Content-Type': content_type}
+        if self.deadline_ms:
+            headers['X-Deadline-Ms'] = str(self.deadline_ms)
+
+        result = {'status': None, 'error': None, 'server': {}}
+        try:
+            connection.request('POST', self.prefix + path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            result['status'] = response.status
+            result['server'] = parse_server_timing(response.getheader('Server-Timing'))
+            if response.getheader('Connection', '').lower() == 'close':
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException) as e:
+            result['error'] = type(e).__name__
+            connection.close()
+            connection = None
+        result['latency_ms'] = (time.perf_counter() - scheduled) * 1000
+        return result, connection
+
+
+def summarize(results, elapsed):
+    """Aggregate per-request results into throughput, percentiles and phase costs."""
+    latencies = sorted(r['latency_ms'] for r in results)
+    ok = [r for r in results if r['status'] == 200]
+    statuses = {}
+    for r in results:
+        key = str(r['status']) if r['status'] is not None else r['error']
+        statuses[key] = statuses.get(key, 0) + 1
+
+    ok_latencies = sorted(r['latency_ms'] for r in ok)
+    summary = {
+        'requests': len(results),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(ok) / elapsed, 2) if elapsed > 0 else 0.0,
+        'error_rate': round(1 - len(ok) / float(len(results)), 4) if results else 0.0,
+        'statuses': statuses,
+        'latency_ms': {
+            'p50': percentile(ok_latencies, 50),
+            'p95': percentile(ok_latencies, 95),
+            'p99': percentile(ok_latencies, 99),
+            'max': ok_latencies[-1] if ok_latencies else None,
+        },
+        'all_latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+        },
+    }
+
+    # Mean per-request breakdown of successful requests
+    if ok:
+        breakdown = {}
+        for phase in SERVER_PHASES:
+            breakdown[phase] = sum(r['server'].get(phase, 0.0) for r in ok) / len(ok)
+        mean_latency = sum(ok_latencies) / len(ok_latencies)
+        breakdown['http_other'] = max(0.0, mean_latency - sum(breakdown.values()))
+        summary['mean_breakdown_ms'] = {k: round(v, 2) for k, v in breakdown.items()}
+        decode = {phase: [r['server'][phase] for r in ok if phase in r['server']] for phase in DECODE_PHASES}
+        if decode['decode']:
+            summary['mean_decode_ms'] = {k: round(sum(v) / len(v), 2) for k, v in decode.items() if v}
+
+    for section in ('latency_ms', 'all_latency_ms'):
+        summary[section] = {k: None if v is None else round(v, 2) for k, v in summary[section].items()}
+    return summary
+
+
+def build_tiny_model(directory):
+    """
+    Write a tiny randomly initialised CLIP model, processor config and
+    classifier checkpoint into directory. Returns (model_id, checkpoint path).
+    """
+    import torch
+    from transformers import CLIPConfig, CLIPImageProcessor, CLIPModel
+    from model_utils import DeepCLIPClassifier
+
+    config = CLIPConfig(
+        text_config={'hidden_size': 32, 'intermediate_size': 64, 'num_hidden_layers': 1,
+                     'num_attention_heads': 2, 'vocab_size': 1000, 'max_position_embeddings': 16},
+        vision_config={'hidden_size': 64, 'intermediate_size': 128, 'num_hidden_layers': 2,
+                       'num_attention_heads': 2, 'image_size': 224, 'patch_size': 32},
+        projection_dim=32,
+    )
+    model_id = os.path.join(directory, 'tiny-clip')
+    CLIPModel(config).save_pretrained(model_id)
+    CLIPImageProcessor(
+        size={'shortest_edge': 224},
+        crop_size={'height': 224, 'width': 224},
+        image_mean=[0.48145466, 0.4578275, 0.40821073],
+        image_std=[0.26862954, 0.26130258, 0.27577711],
+    ).save_pretrained(model_id)
+
+    checkpoint = os.path.join(directory, 'tiny_classifier.pth')
+    torch.save(DeepCLIPClassifier(model_id=model_id).state_dict(), checkpoint)
+    return model_id, checkpoint
+
+
+def serve_in_process(mode, workdir):
+    """
+    Start the Flask app on a threaded werkzeug server in this process.
+
+    Args:
+        mode: 'dummy' or 'real' (tiny random-weight model)
+        workdir: Scratch directory for uploads and the tiny model
+
+    Returns:
+        (base URL, server) - call server.shutdown() when done
+    """
+    from werkzeug.serving import make_server
+    import app as webapp
+    from upload_store import UploadStore
+
+    uploads = os.path.join(workdir, 'uploads')
+    webapp.app.config['UPLOAD_FOLDER'] = uploads
+    webapp.upload_store = UploadStore(uploads)
+    webapp.app.config['MODEL_MODE'] = mode.upper()
+
+    if mode == 'real':
+        model_id, checkpoint = build_tiny_model(workdir)
+        webapp.app.config['CLIP_MODEL_ID'] = model_id
+        webapp.app.config['MODEL_PATH'] = checkpoint
+        webapp.app.config['MODEL_REGISTRY_PATH'] = os.path.join(workdir, 'registry.json')
+        webapp.app.config['EMBEDDING_INDEX_PATH'] = os.path.join(workdir, 'embedding_index')
+        webapp.app.config['MODEL_COMPILE'] = False
+        webapp.load_ml_model()
+
+    # Per-request access logs would dominate the output (and the client's CPU)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, webapp.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server
+
+
+def print_summary(summary, label):
+    latency = summary['latency_ms']
+    print(f"\n{label}")
+    print(f"  requests:    {summary['requests']} in {summary['elapsed_s']} s")
+    print(f"  throughput:  {summary['throughput_rps']} req/s")
+    print(f"  error rate:  {summary['error_rate'] * 100:.2f}%  {summary['statuses']}")
+    print(f"  latency ms:  p50={latency['p50']}  p95={latency['p95']}  p99={latency['p99']}  max={latency['max']}")
+    if 'mean_breakdown_ms' in summary:
+        breakdown = '  '.join(f"{k}={v}" for k, v in summary['mean_breakdown_ms'].items())
+        print(f"  mean ms:     {breakdown}")
+    if 'mean_decode_ms' in summary:
+        decode = '  '.join(f"{k}={v}" for k, v in summary['mean_decode_ms'].items())
+        print(f"  decode ms:   {decode}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the lymphoma classification app.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help="Base URL of a running server")
+    target.add_argument('--serve', choices=['dummy', 'real'],
+                        help="Start the app in-process (real = tiny random-weight model)")
+    parser.add_argument('--images', nargs='+', default=['uploads'],
+                        help="Image files or folders to replay (default: uploads/)")
+    parser.add_argument('--endpoint', choices=['upload', 'batch'], default='upload')
+    parser.add_argument('--batch-size', type=int, default=4, help="Images per /upload/batch request")
+    parser.add_argument('--concurrency', type=int, default=4, help="Maximum requests in flight")
+    parser.add_argument('--rate', type=float, default=None,
+                        help="Open-loop arrival rate in requests/second (default: closed loop)")
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds to run")
+    parser.add_argument('--requests', type=int, default=None, help="Total requests (overrides --duration)")
+    parser.add_argument('--warmup', type=int, default=5, help="Requests sent before measuring")
+    parser.add_argument('--deadline-ms', type=float, default=None, help="X-Deadline-Ms to send")
+    parser.add_argument('--timeout', type=float, default=130.0, help="Per-request timeout in seconds")
+    parser.add_argument('--json', action='store_true', help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    images = []
+    for path in collect_images(args.images):
+        with open(path, 'rb') as f:
+            images.append((os.path.basename(path), f.read()))
+    if not images:
+        parser.error("No images found to replay")
+
+    server = None
+    workdir = None
+    url = args.url
+    if args.serve:
+        workdir = tempfile.TemporaryDirectory()
+        url, server = serve_in_process(args.serve, workdir.name)
+
+    try:
+        options = dict(endpoint=args.endpoint, batch_size=args.batch_size, timeout=args.timeout,
+                       deadline_ms=args.deadline_ms)
+        if args.warmup:
+            LoadGenerator(url, images, concurrency=1, requests=args.warmup, **options).run()
+
+        generator = LoadGenerator(url, images, concurrency=args.concurrency, rate=args.rate,
+                                  duration=args.duration, requests=args.requests, **options)
+        summary = generator.run()
+    finally:
+        if server is not None:
+            server.shutdown()
+        if workdir is not None:
+            workdir.cleanup()
+
+    summary['config'] = {
+        'target': args.serve or url,
+        'endpoint': args.endpoint,
+        'concurrency': args.concurrency,
+        'rate': args.rate,
+        'images': len(images),
+    }
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        mode = 'closed loop' if args.rate is None else f'open loop at {args.rate} req/s'
+        print_summary(summary, f"{summary['config']['target']} /{args.endpoint}, "
+                               f"concurrency {args.concurrency}, {mode}")
+
+
+if __name__ == '__main__':
+    main()
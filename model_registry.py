@@ -0,0 +1,274 @@
+"""
+Registry of classifier checkpoints that share one CLIP vision encoder.
+
+Retrained checkpoints only differ in their classification heads, so the
+registry keeps a single loaded DeepCLIPClassifier as the encoder and one small
+head per named checkpoint. Heads can be added, replaced and routed to
+(including canary routing by percentage) while the app is running.
+
+The registry can be driven by a JSON manifest that every worker process polls:
+
+    {
+        "heads": {
+            "v1": "model/lymphoma_clip_classifier.pth",
+            "v2": "model/head_v2.pth"
+        },
+        "primary": "v1",
+        "canary": "v2",
+        "canary_percent": 5
+    }
+
+Editing (or atomically replacing) the manifest is enough to deploy a new head
+to all workers without a restart.
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import torch.nn as nn
+
+from model_utils import fuse_classifier_head, load_classifier_head
+
+
+class HeadModel(nn.Module):
+    """
+    A named classifier that reuses the registry's shared encoder.
+
+    Exposes the same encode/classify/forward interface as DeepCLIPClassifier,
+    so it can be passed anywhere a loaded model is expected.
+    """
+    def __init__(self, encoder_model, head, name):
+        super(HeadModel, self).__init__()
+        self.encoder_model = encoder_model
+        self.classifier = head
+        self.name = name
+
+    def encode(self, pixel_values, output_attentions=False):
+        return self.encoder_model.encode(pixel_values, output_attentions=output_attentions)
+
+    def classify(self, features):
+        return self.classifier(features)
+
+    def forward(self, pixel_values):
+        return self.classify(self.encode(pixel_values))
+
+
+class ModelRegistry(object):
+    """
+    Named classifier heads over one shared encoder, with atomic routing updates.
+
+    Readers never take a lock: the heads and the routing table are published
+    together as one immutable (heads, routes) snapshot that writers replace
+    with a single assignment, so a reader never sees routes pointing at a head
+    that is not in its heads dict.
+
+    Args:
+        encoder_model: Loaded DeepCLIPClassifier providing the shared encoder
+        device: Device heads are loaded on
+        fuse_heads: Fold BatchNorm/Dropout out of heads as they are added
+            (see model_utils.fuse_classifier_head)
+    """
+    def __init__(self, encoder_model, device='cpu', fuse_heads=False):
+        self.encoder_model = encoder_model
+        self.device = device
+        self.fuse_heads = fuse_heads
+        self.embedding_dim = encoder_model.clip_model.config.projection_dim
+
+        self._state = ({}, {'primary': None, 'canary': None, 'canary_percent': 0.0})
+        self._sources = {}
+        self._write_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+        self._manifest_path = None
+        self._manifest_mtime = None
+        self._failed_manifest = None
+        self._next_poll = 0.0
+
+    def _load_head(self, name, model_path):
+        """Load a checkpoint's head as a HeadModel without publishing it."""
+        head = load_classifier_head(model_path, self.embedding_dim, device=self.device)
+        return self._wrap_head(name, head)
+
+    def _wrap_head(self, name, head):
+        """HeadModel for an already loaded head, fused if configured."""
+        head = head.eval()
+        if self.fuse_heads:
+            head = fuse_classifier_head(head)
+        return HeadModel(self.encoder_model, head, name)
+
+    @staticmethod
+    def _make_routes(heads, primary, canary=None, canary_percent=0.0):
+        """Routing table for heads, validated before anything is published."""
+        canary_percent = float(canary_percent or 0.0)
+        if not 0.0 <= canary_percent <= 100.0:
+            raise ValueError("canary_percent must be between 0 and 100")
+        for name in (primary, canary):
+            if name is not None and name not in heads:
+                raise KeyError(f"Unknown model head: {name}")
+        return {
+            'primary': primary,
+            'canary': canary if canary_percent > 0 else None,
+            'canary_percent': canary_percent if canary else 0.0,
+        }
+
+    def register(self, name, model_path):
+        """Load the head from a checkpoint and add (or replace) it under name."""
+        source = (model_path, os.path.getmtime(model_path))
+        model = self._load_head(name, model_path)
+        with self._write_lock:
+            heads, routes = self._state
+            heads = dict(heads)
+            heads[name] = model
+            self._state = (heads, routes)
+            sources = dict(self._sources)
+            sources[name] = source
+            self._sources = sources
+
+    def add_head(self, name, head):
+        """Add (or replace) an already loaded classification head."""
+        model = self._wrap_head(name, head)
+        with self._write_lock:
+            heads, routes = self._state
+            heads = dict(heads)
+            heads[name] = model
+            self._state = (heads, routes)
+
+    def unregister(self, name):
+        """Remove a head. Heads that are currently routed to cannot be removed."""
+        with self._write_lock:
+            heads, routes = self._state
+            if name in (routes['primary'], routes['canary']):
+                raise ValueError(f"Cannot remove head '{name}' while it is routed to")
+            heads = dict(heads)
+            heads.pop(name, None)
+            self._state = (heads, routes)
+            sources = dict(self._sources)
+            sources.pop(name, None)
+            self._sources = sources
+
+    def set_routes(self, primary, canary=None, canary_percent=0.0):
+        """
+        Atomically switch which heads serve traffic.
+
+        Args:
+            primary: Head serving all traffic not sent to the canary
+            canary: Optional head receiving canary_percent of traffic
+            canary_percent: Share of traffic (0-100) routed to the canary
+        """
+        with self._write_lock:
+            heads, _ = self._state
+            routes = self._make_routes(heads, primary, canary, canary_percent)
+            self._state = (heads, routes)
+
+    def route(self, key=None):
+        """
+        Pick the head for a request.
+
+        Args:
+            key: Optional routing key (e.g. the upload's content hash). The same
+                key always lands on the same head, across worker processes.
+
+        Returns:
+            Tuple of (head name, model)
+        """
+        heads, routes = self._state
+        name = routes['primary']
+        if routes['canary'] is not None:
+            if key is None:
+                bucket = random.random() * 100.0
+            else:
+                digest = hashlib.md5(str(key).encode('utf-8')).digest()
+                bucket = int.from_bytes(digest[:4], 'big') % 10000 / 100.0
+            if bucket < routes['canary_percent']:
+                name = routes['canary']
+        if name is None:
+            raise RuntimeError("No model head is routed to")
+        return name, heads[name]
+
+    def get(self, name):
+        """Model for a specific head, bypassing routing."""
+        return self._state[0][name]
+
+    def status(self):
+        """Registered heads and the current routing table."""
+        heads, routes = self._state
+        return {
+            'heads': sorted(heads),
+            'routes': dict(routes),
+        }
+
+    def load_manifest(self, manifest_path):
+        """
+        Bring the registry in line with a JSON manifest.
+
+        Heads whose checkpoint path or mtime changed are loaded off to the side
+        and checked against the manifest's routes; only then are the new heads
+        and routes published together, and heads missing from the manifest
+        dropped. If anything fails, the registry is left untouched.
+        """
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        current, _ = self._state
+        heads, sources = {}, {}
+        for name, model_path in manifest.get('heads', {}).items():
+            sources[name] = (model_path, os.path.getmtime(model_path))
+            if self._sources.get(name) == sources[name] and name in current:
+                heads[name] = current[name]
+            else:
+                heads[name] = self._load_head(name, model_path)
+
+        routes = self._make_routes(
+            heads,
+            manifest['primary'],
+            canary=manifest.get('canary'),
+            canary_percent=manifest.get('canary_percent', 0.0)
+        )
+
+        with self._write_lock:
+            self._state = (heads, routes)
+            self._sources = sources
+
+        self._manifest_path = manifest_path
+        self._manifest_mtime = os.path.getmtime(manifest_path)
+
+    def refresh(self, manifest_path, interval=1.0):
+        """
+        Reload the manifest if it changed. Cheap enough to call on every
+        request: the file is stat()ed at most once per interval seconds.
+
+        Returns True if the registry was updated.
+        """
+        now = time.monotonic()
+        if now < self._next_poll:
+            return False
+        self._next_poll = now + interval
+
+        try:
+            mtime = os.path.getmtime(manifest_path)
+        except OSError:
+            return False
+        if manifest_path == self._manifest_path and mtime == self._manifest_mtime:
+            return False
+        if (manifest_path, mtime) == self._failed_manifest:
+            # Already failed to load; wait for the manifest to change
+            return False
+
+        # One thread reloads; the others keep serving the current heads
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            self.load_manifest(manifest_path)
+        except Exception as e:
+            # Invalid manifest or an unloadable head (bad path, wrong shape,
+            # corrupt pickle): keep serving the current routes. Registry
+            # maintenance must never fail the request that triggered it.
+            print(f"Error loading model registry manifest: {e}")
+            self._failed_manifest = (manifest_path, mtime)
+            return False
+        finally:
+            self._refresh_lock.release()
+        return True
@@ -5,7 +5,109 @@ import torch
 import torch.nn as nn
 from transformers import CLIPProcessor, CLIPModel
 from PIL import Image
+from contextlib import contextmanager
+import math
 import os
+import threading
+import time
+
+# Upper bound on pixels decoded per image (~75MB as RGB). Larger images are
+# decoded at a reduced resolution, or rejected if the format can't do that.
+MAX_DECODE_PIXELS = 25_000_000
+
+# Observed full-resolution decode cost per format (ms per megapixel), used to
+# estimate how much time reduced-resolution decoding saves
+_full_decode_ms_per_mp = {}
+
+# Serialises switching the vision encoder to eager attention for explanations
+_eager_attention_lock = threading.Lock()
+
+class ImageTooLarge(ValueError):
+    """The image needs more pixels to decode than the decode budget allows."""
+    pass
+
+@contextmanager
+def _eager_attention(clip_model):
+    """
+    Run the vision encoder with eager attention, which is the only
+    implementation that materialises attention weights (SDPA and flash
+    attention never do). The setting lives on the shared config, so requests
+    running on the same model at the same time also use (slower) eager
+    attention until the explain pass finishes; their results are unchanged.
+    """
+    config = clip_model.vision_model.config
+    with _eager_attention_lock:
+        previous = getattr(config, '_attn_implementation', None)
+        if previous in (None, 'eager'):
+            yield
+        else:
+            config._attn_implementation = 'eager'
+            try:
+                yield
+            finally:
+                config._attn_implementation = previous
+
+def attention_rollout(attentions):
+    """
+    Attention rollout saliency for ViT attention maps (Abnar & Zuidema, 2020).
+    
+    Head-averaged attention of each layer is mixed with the identity (for the
+    residual connection), row-normalised and multiplied through the layers;
+    the CLS token's row over the patch tokens is the saliency map.
+    
+    Args:
+        attentions: Sequence of per-layer tensors of shape (B, heads, T, T)
+        
+    Returns:
+        Tensor of shape (B, grid, grid) scaled to [0, 1]
+    """
+    if not attentions or attentions[0] is None:
+        raise RuntimeError("The vision encoder did not return attention maps")
+    
+    attn = torch.stack([layer.float().mean(dim=1) for layer in attentions])
+    tokens = attn.shape[-1]
+    attn = 0.5 * attn + 0.5 * torch.eye(tokens, device=attn.device)
+    attn = attn / attn.sum(dim=-1, keepdim=True)
+    
+    rollout = attn[0]
+    for layer in attn[1:]:
+        rollout = torch.bmm(layer, rollout)
+    
+    saliency = rollout[:, 0, 1:]
+    grid = int(math.sqrt(saliency.shape[-1]))
+    saliency = saliency.reshape(-1, grid, grid)
+    low = saliency.amin(dim=(1, 2), keepdim=True)
+    high = saliency.amax(dim=(1, 2), keepdim=True)
+    return (saliency - low) / (high - low).clamp_min(1e-12)
+
+def build_classifier_head(embedding_dim, num_classes=3):
+    """
+    Deep classification head that sits on top of the CLIP image embedding.
+    Matches the exact architecture used during training.
+    """
+    # Added Batch Normalization to help the deep layers converge faster
+    return nn.Sequential(
+        # Layer 1: Expansion or projection
+        nn.Linear(embedding_dim, 1024),
+        nn.BatchNorm1d(1024),
+        nn.ReLU(),
+        nn.Dropout(0.3),
+        
+        # Layer 2: Deep Processing
+        nn.Linear(1024, 512),
+        nn.BatchNorm1d(512),
+        nn.ReLU(),
+        nn.Dropout(0.3),
+        
+        # Layer 3: Feature Compression
+        nn.Linear(512, 256),
+        nn.BatchNorm1d(256),
+        nn.ReLU(),
+        nn.Dropout(0.2),
+        
+        # Output Layer
+        nn.Linear(256, num_classes)
+    )
 
 class DeepCLIPClassifier(nn.Module):
     """
@@ -26,47 +128,53 @@ class DeepCLIPClassifier(nn.Module):
         embedding_dim = self.clip_model.config.projection_dim
         
         # Deep Classification Head
-        # Added Batch Normalization to help the deep layers converge faster
-        self.classifier = nn.Sequential(
-            # Layer 1: Expansion or projection
-            nn.Linear(embedding_dim, 1024),
-            nn.BatchNorm1d(1024),
-            nn.ReLU(),
-            nn.Dropout(0.3),
-            
-            # Layer 2: Deep Processing
-            nn.Linear(1024, 512),
-            nn.BatchNorm1d(512),
-            nn.ReLU(),
-            nn.Dropout(0.3),
-            
-            # Layer 3: Feature Compression
-            nn.Linear(512, 256),
-            nn.BatchNorm1d(256),
-            nn.ReLU(),
-            nn.Dropout(0.2),
-            
-            # Output Layer
-            nn.Linear(256, num_classes)
-        )
+        self.classifier = build_classifier_head(embedding_dim, num_classes)
         
-    def forward(self, pixel_values):
+    def encode(self, pixel_values, output_attentions=False):
         """
-        Forward pass through CLIP vision encoder and classification head.
+        Normalized CLIP image embeddings for a batch of preprocessed images.
         
         Args:
             pixel_values: Preprocessed image tensors
+            output_attentions: Also return the vision encoder's attention maps
+                from this same forward pass (one (B, heads, T, T) tensor per layer)
             
         Returns:
-            Logits for each class
+            Embeddings, or (embeddings, attentions) if output_attentions is set
         """
-        # Extract the pre-projected embeddings from CLIP
-        outputs = self.clip_model.get_image_features(pixel_values=pixel_values)
+        # Same computation as CLIPModel.get_image_features, keeping the attentions
+        if output_attentions:
+            with _eager_attention(self.clip_model):
+                vision_outputs = self.clip_model.vision_model(pixel_values=pixel_values,
+                                                              output_attentions=True)
+        else:
+            vision_outputs = self.clip_model.vision_model(pixel_values=pixel_values)
+        outputs = self.clip_model.visual_projection(vision_outputs.pooler_output)
         
         # Ensure outputs are normalized if they aren't already
         outputs = outputs / outputs.norm(dim=-1, keepdim=True)
         
-        return self.classifier(outputs)
+        if output_attentions:
+            return outputs, vision_outputs.attentions
+        return outputs
+    
+    def classify(self, features):
+        """
+        Logits for each class from normalized embeddings.
+        """
+        return self.classifier(features)
+        
+    def forward(self, pixel_values):
+        """
+        Forward pass through CLIP vision encoder and classification head.
+        
+        Args:
+            pixel_values: Preprocessed image tensors
+            
+        Returns:
+            Logits for each class
+        """
+        return self.classify(self.encode(pixel_values))
 
 def is_valid_image(filename):
     """
@@ -77,19 +185,24 @@ def is_valid_image(filename):
     ext = os.path.splitext(filename.lower())[1]
     return ext in valid_extensions
 
-def load_model(model_path, device='cpu'):
+def load_model(model_path, device='cpu', model_id="openai/clip-vit-large-patch14", optimize=False,
+               compile_model=False, compile_cache_dir=None):
     """
     Load the trained Deep CLIP classifier model.
     
     Args:
         model_path: Path to the .pth model file
         device: Device to load model on ('cpu' or 'cuda')
+        model_id: Hugging Face id of the CLIP model used during training
+        optimize: Run optimize_for_inference on the loaded model
+        compile_model: With optimize, also torch.compile the vision encoder
+        compile_cache_dir: Persistent directory for compiled kernels
         
     Returns:
         Loaded model in evaluation mode
     """
     # Initialize model architecture - must match training exactly
-    model = DeepCLIPClassifier(model_id="openai/clip-vit-large-patch14", num_classes=3)
+    model = DeepCLIPClassifier(model_id=model_id, num_classes=3)
     
     # Load trained weights
     model.load_state_dict(torch.load(model_path, map_location=device))
@@ -100,28 +213,383 @@ def load_model(model_path, device='cpu'):
     # Move to device
     model = model.to(device)
     
+    if optimize:
+        report = optimize_for_inference(model, compile_model=compile_model, cache_dir=compile_cache_dir)
+        print(f"Optimized model for inference: {report}")
+    
     return model
 
-def preprocess_image(image_path, processor):
+def _fold_batchnorm(linear, batchnorm):
+    """Linear layer equivalent to linear followed by batchnorm in eval mode."""
+    with torch.no_grad():
+        scale = torch.rsqrt(batchnorm.running_var + batchnorm.eps)
+        if batchnorm.weight is not None:
+            scale = scale * batchnorm.weight
+        shift = -batchnorm.running_mean * scale
+        if batchnorm.bias is not None:
+            shift = shift + batchnorm.bias
+        bias = linear.bias if linear.bias is not None else torch.zeros_like(batchnorm.running_mean)
+        
+        fused = nn.Linear(linear.in_features, linear.out_features, bias=True)
+        fused = fused.to(device=linear.weight.device, dtype=linear.weight.dtype)
+        fused.weight.copy_(linear.weight * scale[:, None])
+        fused.bias.copy_(bias * scale + shift)
+    return fused
+
+def fuse_classifier_head(classifier):
+    """
+    Inference-only version of a classification head: every BatchNorm1d is
+    folded into the Linear layer before it and Dropout layers are removed.
+    Gives the same outputs as the original head in eval mode.
+    """
+    layers = []
+    for module in classifier:
+        if isinstance(module, nn.BatchNorm1d) and layers and isinstance(layers[-1], nn.Linear):
+            layers[-1] = _fold_batchnorm(layers[-1], module)
+        elif isinstance(module, nn.Dropout):
+            continue
+        else:
+            layers.append(module)
+    return nn.Sequential(*layers).eval()
+
+def _use_fastest_attention(clip_model):
+    """
+    Switch CLIP to fused scaled-dot-product attention where transformers
+    supports changing it after loading. Returns the implementation in use.
+    """
+    config = clip_model.vision_model.config
+    if getattr(config, '_attn_implementation', None) == 'sdpa':
+        return 'sdpa'
+    try:
+        if hasattr(clip_model, 'set_attn_implementation'):
+            clip_model.set_attn_implementation('sdpa')
+        else:
+            # Versions that pick the attention function per call from the config
+            clip_model.config._attn_implementation = 'sdpa'
+            config._attn_implementation = 'sdpa'
+    except (ValueError, ImportError) as e:
+        print(f"Fused attention not available, keeping {config._attn_implementation}: {e}")
+    return getattr(config, '_attn_implementation', None) or 'eager'
+
+def _compile_vision_model(model, cache_dir=None):
+    """
+    torch.compile the vision encoder. With cache_dir, compiled artifacts are
+    kept there across restarts (Inductor's on-disk caches, plus the portable
+    mega-cache on torch versions that have it).
+    """
+    cache_file = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+        try:
+            import torch._inductor.config as inductor_config
+            inductor_config.fx_graph_cache = True
+        except (ImportError, AttributeError):
+            pass
+        cache_file = os.path.join(cache_dir, 'compile_artifacts.bin')
+        if os.path.exists(cache_file) and hasattr(torch.compiler, 'load_cache_artifacts'):
+            with open(cache_file, 'rb') as f:
+                torch.compiler.load_cache_artifacts(f.read())
+    
+    model.clip_model.vision_model = torch.compile(model.clip_model.vision_model)
+    return cache_file
+
+def optimize_for_inference(model, compile_model=False, cache_dir=None, verify=True, tolerance=1e-3):
+    """
+    Optimize a loaded DeepCLIPClassifier for inference in place.
+    
+    Folds the BatchNorm layers of the classification head into the preceding
+    Linear layers (dropping Dropout), switches the vision encoder to fused
+    scaled-dot-product attention and optionally compiles it. When compiling,
+    the graphs for single images, batches and explanations are all built here
+    rather than on the first request that needs them.
+    
+    Args:
+        model: Loaded DeepCLIPClassifier in evaluation mode
+        compile_model: torch.compile the vision encoder
+        cache_dir: Persistent compile cache directory (see _compile_vision_model)
+        verify: Check logits on a probe batch against the eager model
+        tolerance: Maximum allowed absolute logit difference
+        
+    Returns:
+        Dict describing the applied optimizations
+        
+    Raises:
+        RuntimeError: If the optimized model's logits differ from the eager model's
+    """
+    device = next(model.parameters()).device
+    image_size = model.clip_model.config.vision_config.image_size
+    generator = torch.Generator().manual_seed(0)
+    probe = torch.randn(2, 3, image_size, image_size, generator=generator).to(device)
+    
+    reference = None
+    if verify:
+        with torch.no_grad():
+            reference = model(probe)
+    
+    model.classifier = fuse_classifier_head(model.classifier)
+    attention = _use_fastest_attention(model.clip_model)
+    
+    cache_file = None
+    if compile_model:
+        cache_file = _compile_vision_model(model, cache_dir=cache_dir)
+        # The probe stands in for every bulk batch size: with its batch
+        # dimension marked dynamic, one graph serves all batches of 2 or more
+        # instead of recompiling for each new size
+        torch._dynamo.mark_dynamic(probe, 0)
+    
+    report = {'fused_head': True, 'attention': attention, 'compiled': bool(compile_model)}
+    
+    start = time.perf_counter()
+    with torch.no_grad():
+        if compile_model:
+            # Compile every variant requests use now, so none pays for it.
+            # Explanations run the encoder with eager attention, and their
+            # first call installs transformers' output-capturing hooks, which
+            # changes the call path of every later forward pass; so it goes
+            # first. Interactive uploads run at batch 1, which the compiler
+            # always specialises.
+            single = probe[:1].clone()
+            model.encode(single, output_attentions=True)
+            model(single)
+        optimized = model(probe)
+    report['warmup_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    
+    # Saved after every warm-up so the artifacts cover all of the graphs above
+    if cache_file and hasattr(torch.compiler, 'save_cache_artifacts'):
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is not None:
+            with open(cache_file, 'wb') as f:
+                f.write(artifacts[0])
+    
+    if reference is not None:
+        max_diff = (optimized - reference).abs().max().item()
+        report['max_logit_diff'] = max_diff
+        if max_diff > tolerance:
+            raise RuntimeError(
+                f"Optimized model differs from the eager model (max logit difference {max_diff:.2e})"
+            )
+    
+    return report
+
+def load_classifier_head(model_path, embedding_dim, device='cpu'):
+    """
+    Load only the classification head from a checkpoint.
+    
+    Works with full training checkpoints and with head-only checkpoints written
+    by save_classifier_head. Full checkpoints are memory-mapped so the CLIP
+    weights they contain are never read from disk.
+    
+    Args:
+        model_path: Path to the .pth checkpoint
+        embedding_dim: CLIP projection dimension the head was trained on
+        device: Device to load the head on
+        
+    Returns:
+        Classification head (nn.Sequential) in evaluation mode
+    """
+    try:
+        state_dict = torch.load(model_path, map_location='cpu', mmap=True, weights_only=True)
+    except (TypeError, RuntimeError):
+        # Older torch without mmap support, or a legacy (non-zip) checkpoint
+        state_dict = torch.load(model_path, map_location='cpu')
+    
+    prefix = 'classifier.'
+    head_state = {
+        key[len(prefix):]: value.clone()
+        for key, value in state_dict.items()
+        if key.startswith(prefix)
+    }
+    if not head_state:
+        raise ValueError(f"No classifier weights found in {model_path}")
+    
+    # Number of classes comes from the output layer
+    last_weight = max(
+        (key for key in head_state if key.endswith('.weight')),
+        key=lambda key: int(key.split('.')[0])
+    )
+    num_classes = head_state[last_weight].shape[0]
+    
+    head = build_classifier_head(embedding_dim, num_classes)
+    head.load_state_dict(head_state)
+    head.eval()
+    return head.to(device)
+
+def save_classifier_head(model, model_path):
+    """
+    Save only the classification head of a DeepCLIPClassifier (a few MB instead
+    of the full CLIP checkpoint). The file can be loaded with load_classifier_head.
+    """
+    torch.save(
+        {f'classifier.{key}': value for key, value in model.classifier.state_dict().items()},
+        model_path
+    )
+
+def _processor_min_side(processor, default=224):
+    """Shortest image side the CLIP processor needs before it resizes and crops."""
+    image_processor = getattr(processor, 'image_processor', processor)
+    size = getattr(image_processor, 'size', None)
+    if isinstance(size, int):
+        return size
+    if size is not None:
+        shortest = size.get('shortest_edge')
+        if shortest:
+            return shortest
+        if size.get('height') and size.get('width'):
+            return min(size.get('height'), size.get('width'))
+    return default
+
+def _select_pyramid_level(image, min_side):
+    """
+    Seek a multi-resolution TIFF to its smallest level that is still at least
+    min_side on its shortest side. Pages with a different aspect ratio than the
+    base level (labels, macro images) are ignored.
+
+    Returns True if a reduced level was selected.
+    """
+    base_w, base_h = image.size
+    best_frame, best_pixels = 0, base_w * base_h
+    for frame in range(1, image.n_frames):
+        image.seek(frame)
+        w, h = image.size
+        if min(w, h) < min_side or abs(w / h - base_w / base_h) > 0.02 * base_w / base_h:
+            continue
+        if w * h < best_pixels:
+            best_frame, best_pixels = frame, w * h
+    image.seek(best_frame)
+    return best_frame != 0
+
+def decode_image(image_path, min_side=224, max_pixels=MAX_DECODE_PIXELS):
+    """
+    Decode an image at the smallest resolution that still covers min_side.
+
+    Uses JPEG DCT scaling (draft mode) and lower pyramid levels of
+    multi-resolution TIFFs so the full-resolution pixels are never decoded,
+    then box-reduces by an integer factor so downstream resizing is cheap.
+    The result keeps at least twice min_side on its shortest side so the
+    processor's own antialiased resize still sees enough detail; reducing
+    straight to min_side visibly changes the model inputs.
+
+    Args:
+        image_path: Path to the image file
+        min_side: Minimum length of the shortest side after decoding
+        max_pixels: Maximum number of pixels that may be decoded
+
+    Returns:
+        Tuple of (RGB PIL image, stats dict). The stats contain the source and
+        decoded sizes, the decode time and an estimate of the decode time saved
+        compared to a full-resolution decode, based on the full-resolution
+        decodes of the same format seen so far (None until one has been seen).
+
+    Raises:
+        ImageTooLarge: If the image would need more than max_pixels to decode
+    """
+    start = time.perf_counter()
+    try:
+        image = Image.open(image_path)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    format_name = image.format
+    source_size = image.size
+    methods = []
+    target_side = 2 * min_side
+
+    if image.format == 'TIFF' and getattr(image, 'n_frames', 1) > 1:
+        if _select_pyramid_level(image, target_side):
+            methods.append('pyramid')
+    elif image.format == 'JPEG':
+        image.draft('RGB', (target_side, target_side))
+        if image.size != source_size:
+            methods.append('draft')
+
+    decoded_size = image.size
+    if decoded_size[0] * decoded_size[1] > max_pixels:
+        raise ImageTooLarge(
+            f"Image too large to decode: {decoded_size[0]}x{decoded_size[1]} "
+            f"exceeds the budget of {max_pixels} pixels"
+        )
+
+    image = image.convert('RGB')
+
+    factor = min(image.size) // target_side
+    if factor >= 2:
+        image = image.reduce(factor)
+        methods.append('reduce')
+
+    decode_ms = (time.perf_counter() - start) * 1000
+    source_mp = source_size[0] * source_size[1] / 1e6
+
+    # Calibrate on full-resolution decodes; estimate savings for reduced ones
+    est_saved_ms = None
+    if decoded_size == source_size:
+        rate = decode_ms / max(source_mp, 1e-6)
+        previous = _full_decode_ms_per_mp.get(format_name)
+        _full_decode_ms_per_mp[format_name] = rate if previous is None else 0.9 * previous + 0.1 * rate
+        est_saved_ms = 0.0
+    elif format_name in _full_decode_ms_per_mp:
+        est_saved_ms = max(0.0, _full_decode_ms_per_mp[format_name] * source_mp - decode_ms)
+
+    stats = {
+        'source_size': source_size,
+        'decoded_size': decoded_size,
+        'output_size': image.size,
+        'method': '+'.join(methods) or 'full',
+        'decode_ms': round(decode_ms, 2),
+        # None until a full-resolution decode of this format has been timed
+        'est_saved_ms': None if est_saved_ms is None else round(est_saved_ms, 2),
+    }
+    return image, stats
+
+def preprocess_image(image_path, processor, details=None):
     """
     Preprocess a single image for CLIP model inference.
     
     Args:
         image_path: Path to the image file
         processor: CLIP processor for image preprocessing
+        details: Optional dict that receives per-request diagnostics
+            (decode statistics under 'decode')
         
     Returns:
         Preprocessed image tensor ready for model input
     """
-    # Load and convert to RGB if needed
-    image = Image.open(image_path).convert('RGB')
+    # Decode at the smallest resolution the processor needs, as RGB
+    image, stats = decode_image(image_path, min_side=_processor_min_side(processor))
+    if details is not None:
+        details['decode'] = stats
     
     # Preprocess with CLIP processor
     inputs = processor(images=image, return_tensors="pt")
     
     return inputs['pixel_values']
 
-def predict_image(model, image_path, processor, device='cpu', class_names=None):
+def encode_images(model, image_paths, processor, device='cpu', batch_size=16):
+    """
+    Normalized embeddings for many images, encoded in batches.
+    
+    Args:
+        model: Loaded DeepCLIPClassifier model
+        image_paths: List of image file paths
+        processor: CLIP processor
+        device: Device to run inference on
+        batch_size: Images per forward pass
+        
+    Returns:
+        Float tensor of shape (len(image_paths), embedding_dim) on the CPU
+    """
+    embeddings = []
+    for start in range(0, len(image_paths), batch_size):
+        batch = image_paths[start:start + batch_size]
+        pixel_values = torch.cat([preprocess_image(path, processor) for path in batch])
+        with torch.no_grad():
+            embeddings.append(model.encode(pixel_values.to(device)).float().cpu())
+    
+    if not embeddings:
+        return torch.empty(0, model.clip_model.config.projection_dim)
+    return torch.cat(embeddings)
+
+def predict_image(model, image_path, processor, device='cpu', class_names=None, details=None,
+                  explain=False):
     """
     Run inference on a single image.
     
@@ -131,6 +599,10 @@ def predict_image(model, image_path, processor, device='cpu', class_names=None):
         processor: CLIP processor
         device: Device to run inference on
         class_names: List of class names in order [DLBCL, Follicular, Hodgkin]
+        details: Optional dict that receives per-request diagnostics and the
+            normalized image embedding (under 'embedding')
+        explain: Also compute an attention-rollout heatmap from the same
+            forward pass into details['heatmap'] (requires details)
         
     Returns:
         Tuple of (predicted_class_name, confidence_percentage, description)
@@ -139,15 +611,36 @@ def predict_image(model, image_path, processor, device='cpu', class_names=None):
         class_names = ['DLBCL', 'Follicular', 'Hodgkin']
     
     # Preprocess image
-    pixel_values = preprocess_image(image_path, processor)
+    pixel_values = preprocess_image(image_path, processor, details=details)
     pixel_values = pixel_values.to(device)
     
     # Run inference
+    explain = explain and details is not None
     with torch.no_grad():
-        logits = model(pixel_values)
+        if explain:
+            features, attentions = model.encode(pixel_values, output_attentions=True)
+        else:
+            features = model.encode(pixel_values)
+        logits = model.classify(features)
         probabilities = torch.softmax(logits, dim=1)
         confidence, predicted_idx = torch.max(probabilities, 1)
     
+    if details is not None:
+        # Normalized embedding from the same forward pass, for similarity search
+        details['embedding'] = features[0].float().cpu()
+    
+    if explain:
+        start = time.perf_counter()
+        try:
+            with torch.no_grad():
+                heatmap = attention_rollout(attentions)[0].cpu()
+        except Exception as e:
+            # The heatmap is an extra: keep the prediction without it
+            print(f"Error computing attention heatmap: {e}")
+        else:
+            details['heatmap'] = [[round(v, 3) for v in row] for row in heatmap.tolist()]
+            details['explain_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    
     # Get predicted class
     predicted_idx = predicted_idx.item()
     confidence_value = confidence.item() * 100
@@ -173,3 +666,59 @@ def predict_image(model, image_path, processor, device='cpu', class_names=None):
     description = descriptions.get(class_name, 'Lymphoma subtype classification.')
     
     return display_name, f"{confidence_value:.2f}%", description
+
+def predict_images(model, image_paths, processor, device='cpu', class_names=None, batch_size=16):
+    """
+    Run batched inference on many images.
+    
+    Images that cannot be decoded are reported individually instead of
+    failing the whole batch.
+    
+    Args:
+        model: Loaded DeepCLIPClassifier model
+        image_paths: List of image file paths
+        processor: CLIP processor
+        device: Device to run inference on
+        class_names: List of class names in order [DLBCL, Follicular, Hodgkin]
+        batch_size: Images per forward pass
+        
+    Returns:
+        List with one dict per path, in order: {'path', 'prediction',
+        'confidence', 'probabilities' (class name -> probability)} or
+        {'path', 'error'}
+    """
+    if class_names is None:
+        class_names = ['DLBCL', 'Follicular', 'Hodgkin']
+    
+    results = []
+    for start in range(0, len(image_paths), batch_size):
+        batch = image_paths[start:start + batch_size]
+        
+        tensors, indices, batch_results = [], [], []
+        for path in batch:
+            try:
+                tensors.append(preprocess_image(path, processor))
+                indices.append(len(batch_results))
+                batch_results.append(None)
+            except Exception as e:
+                batch_results.append({'path': path, 'error': str(e)})
+        
+        if tensors:
+            with torch.no_grad():
+                logits = model(torch.cat(tensors).to(device))
+                probabilities = torch.softmax(logits, dim=1).cpu()
+            
+            for i, probs in zip(indices, probabilities):
+                predicted_idx = int(torch.argmax(probs))
+                batch_results[i] = {
+                    'path': batch[i],
+                    'prediction': class_names[predicted_idx],
+                    'confidence': round(float(probs[predicted_idx]), 6),
+                    'probabilities': {
+                        name: round(float(p), 6) for name, p in zip(class_names, probs)
+                    },
+                }
+        
+        results.extend(batch_results)
+    
+    return results
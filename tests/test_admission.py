@@ -0,0 +1,175 @@
+import threading
+import time
+
+import pytest
+
+from admission import (BULK, INTERACTIVE, AdmissionController, DeadlineExceeded, QueueFull,
+                       parse_deadline, parse_priority)
+
+
+def wait_for(condition, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise AssertionError("Timed out waiting for condition")
+        time.sleep(0.005)
+
+
+class Waiter(threading.Thread):
+    """Acquires a slot in the background and records the outcome."""
+
+    def __init__(self, controller, name, priority, order, deadline=None):
+        super(Waiter, self).__init__(daemon=True)
+        self.controller = controller
+        self.name = name
+        self.priority = priority
+        self.order = order
+        self.deadline = deadline
+        self.error = None
+
+    def run(self):
+        try:
+            self.controller.acquire(priority=self.priority, deadline=self.deadline)
+        except Exception as e:
+            self.error = e
+            return
+        self.order.append(self.name)
+        self.controller.release()
+
+
+def queue_waiter(controller, name, priority, order, deadline=None):
+    queued = controller.stats()['queued']
+    waiter = Waiter(controller, name, priority, order, deadline=deadline)
+    waiter.start()
+    wait_for(lambda: controller.stats()['queued'] == queued + 1)
+    return waiter
+
+
+def test_free_slot_is_granted_immediately():
+    controller = AdmissionController(max_concurrent=2, max_queue=0)
+    controller.acquire()
+    controller.acquire(priority=BULK)
+    assert controller.stats()['active'] == 2
+    with pytest.raises(QueueFull):
+        controller.acquire()
+
+
+def test_interactive_is_served_before_bulk():
+    controller = AdmissionController(max_concurrent=1, max_queue=4)
+    order = []
+    controller.acquire()
+
+    waiters = [
+        queue_waiter(controller, 'bulk-1', BULK, order),
+        queue_waiter(controller, 'bulk-2', BULK, order),
+        queue_waiter(controller, 'interactive', INTERACTIVE, order),
+    ]
+    controller.release()
+    for waiter in waiters:
+        waiter.join(2.0)
+
+    assert order == ['interactive', 'bulk-1', 'bulk-2']
+    assert controller.stats()['active'] == 0
+    assert controller.stats()['queued'] == 0
+
+
+def test_newest_bulk_waiter_is_displaced_when_full():
+    controller = AdmissionController(max_concurrent=1, max_queue=2)
+    order = []
+    controller.acquire()
+
+    oldest = queue_waiter(controller, 'bulk-old', BULK, order)
+    newest = queue_waiter(controller, 'bulk-new', BULK, order)
+    assert not controller.is_saturated(INTERACTIVE)
+    assert controller.is_saturated(BULK)
+
+    interactive = Waiter(controller, 'interactive', INTERACTIVE, order)
+    interactive.start()
+    newest.join(2.0)
+    assert isinstance(newest.error, QueueFull)
+
+    controller.release()
+    oldest.join(2.0)
+    interactive.join(2.0)
+    assert order == ['interactive', 'bulk-old']
+    assert oldest.error is None
+
+
+def test_bulk_request_is_rejected_when_full():
+    controller = AdmissionController(max_concurrent=1, max_queue=1)
+    controller.acquire()
+    queue_waiter(controller, 'bulk', BULK, [])
+
+    with pytest.raises(QueueFull):
+        controller.acquire(priority=BULK)
+    # An interactive request would displace the waiting bulk request instead
+    assert not controller.is_saturated(INTERACTIVE)
+
+
+def test_deadline_expires_while_queued():
+    controller = AdmissionController(max_concurrent=1, max_queue=4)
+    controller.acquire()
+
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        controller.acquire(deadline=time.monotonic() + 0.05)
+    assert 0.04 <= time.monotonic() - start < 1.0
+    assert controller.stats()['queued'] == 0
+
+
+def test_expired_waiter_does_not_take_a_slot():
+    controller = AdmissionController(max_concurrent=1, max_queue=4)
+    order = []
+    controller.acquire()
+
+    expired = queue_waiter(controller, 'expired', INTERACTIVE, order, deadline=time.monotonic() + 0.05)
+    expired.join(2.0)
+    waiting = queue_waiter(controller, 'waiting', BULK, order)
+    controller.release()
+    waiting.join(2.0)
+
+    assert isinstance(expired.error, DeadlineExceeded)
+    assert order == ['waiting']
+
+
+def test_past_deadline_is_rejected_without_queueing():
+    controller = AdmissionController()
+    with pytest.raises(DeadlineExceeded):
+        controller.acquire(deadline=time.monotonic() - 1)
+    assert controller.stats()['active'] == 0
+
+
+def test_retry_after_on_full_queue():
+    controller = AdmissionController(max_concurrent=1, max_queue=2, default_service_time=3.0)
+    controller.acquire()
+    queue_waiter(controller, 'bulk-1', BULK, [])
+    queue_waiter(controller, 'bulk-2', BULK, [])
+
+    with pytest.raises(QueueFull) as excinfo:
+        controller.acquire(priority=BULK)
+    # Two waiters ahead plus this request, 3 seconds each
+    assert excinfo.value.retry_after == 9
+    assert controller.retry_after() == 9.0
+
+
+def test_retry_after_tracks_service_time():
+    controller = AdmissionController(default_service_time=1.0)
+    for _ in range(50):
+        controller.acquire()
+        controller.release(service_time=4.0)
+    assert controller.stats()['service_time'] == pytest.approx(4.0, abs=0.01)
+    assert controller.retry_after() == pytest.approx(4.0, abs=0.01)
+
+
+def test_parse_priority_and_deadline():
+    assert parse_priority('bulk') == BULK
+    assert parse_priority('Batch') == BULK
+    assert parse_priority('unknown') == INTERACTIVE
+    assert parse_priority(None, default=BULK) == BULK
+
+    assert parse_deadline(None) is None
+    assert parse_deadline('not a number') is None
+    assert parse_deadline('0') is None
+    deadline = parse_deadline('500')
+    assert 0.4 < deadline - time.monotonic() <= 0.5
+    assert parse_deadline(None, default_ms=1000) - time.monotonic() > 0.9
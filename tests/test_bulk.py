@@ -0,0 +1,144 @@
+import threading
+import time
+
+import pytest
+
+import bulk
+from bulk import DONE, FAILED, LEASED, PENDING, ShardQueue
+
+
+class Clock(object):
+    """Stands in for the time module inside bulk, with a settable time()."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleep = time.sleep
+        self.monotonic = time.monotonic
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bulk, 'time', clock)
+    return clock
+
+
+def make_queue(tmp_path, shards=2, **kwargs):
+    queue = ShardQueue(str(tmp_path / 'queue.sqlite'), **kwargs)
+    queue.add([(i, f'shard-{i}.txt', 10) for i in range(shards)])
+    return queue
+
+
+def status(queue, shard_id):
+    return next(s for s in queue.shards() if s['id'] == shard_id)
+
+
+def test_claims_hand_out_each_shard_once(tmp_path, clock):
+    queue = make_queue(tmp_path)
+    assert queue.claim('a') == (0, 'shard-0.txt')
+    assert queue.claim('b') == (1, 'shard-1.txt')
+    assert queue.claim('c') is None
+    assert queue.counts()[LEASED] == {'shards': 2, 'images': 20}
+
+
+def test_expired_lease_is_reclaimed(tmp_path, clock):
+    queue = make_queue(tmp_path, shards=1, lease_seconds=60)
+    assert queue.claim('a') == (0, 'shard-0.txt')
+
+    clock.now += 59
+    assert queue.claim('b') is None
+
+    clock.now += 2
+    assert queue.claim('b') == (0, 'shard-0.txt')
+    assert status(queue, 0)['owner'] == 'b'
+    assert status(queue, 0)['attempts'] == 2
+
+    # The stale worker can neither keep nor publish the shard
+    assert not queue.renew(0, 'a')
+    assert not queue.complete(0, 'a', 'out-a.jsonl')
+    assert queue.complete(0, 'b', 'out-b.jsonl')
+    assert status(queue, 0)['status'] == DONE
+    assert status(queue, 0)['output'] == 'out-b.jsonl'
+
+
+def test_renewed_lease_is_not_reclaimed(tmp_path, clock):
+    queue = make_queue(tmp_path, shards=1, lease_seconds=60)
+    queue.claim('a')
+    clock.now += 50
+    assert queue.renew(0, 'a')
+    clock.now += 50
+    assert queue.claim('b') is None
+    assert status(queue, 0)['owner'] == 'a'
+
+
+def test_shard_that_keeps_expiring_is_failed(tmp_path, clock):
+    queue = make_queue(tmp_path, shards=1, lease_seconds=60, max_attempts=2)
+    assert queue.claim('a') is not None
+    clock.now += 61
+    assert queue.claim('b') is not None
+    clock.now += 61
+    assert queue.claim('c') is None
+
+    shard = status(queue, 0)
+    assert shard['status'] == FAILED
+    assert shard['error'] == 'lease expired'
+    assert queue.unfinished() == 0
+
+
+def test_failures_count_towards_max_attempts(tmp_path, clock):
+    queue = make_queue(tmp_path, shards=1, max_attempts=2)
+    queue.claim('a')
+    queue.fail(0, 'a', 'bad image list')
+    assert status(queue, 0)['status'] == PENDING
+
+    queue.claim('a')
+    queue.fail(0, 'a', 'bad image list')
+    assert status(queue, 0)['status'] == FAILED
+    assert status(queue, 0)['error'] == 'bad image list'
+
+    assert queue.requeue() == 1
+    shard = status(queue, 0)
+    assert (shard['status'], shard['attempts'], shard['error']) == (PENDING, 0, None)
+
+
+def test_release_does_not_count_an_attempt(tmp_path, clock):
+    queue = make_queue(tmp_path, shards=1, max_attempts=1)
+    for _ in range(3):
+        assert queue.claim('a') is not None
+        queue.release(0, 'a')
+    assert status(queue, 0)['attempts'] == 0
+    assert status(queue, 0)['status'] == PENDING
+
+
+def test_requeue_selected_shards(tmp_path, clock):
+    queue = make_queue(tmp_path, shards=3, max_attempts=1)
+    for owner in 'abc':
+        shard_id, _ = queue.claim(owner)
+        queue.fail(shard_id, owner, 'error')
+    assert queue.requeue([0, 2]) == 2
+    assert [s['id'] for s in queue.shards(PENDING)] == [0, 2]
+    assert [s['id'] for s in queue.shards(FAILED)] == [1]
+
+
+def test_concurrent_workers_never_share_a_shard(tmp_path):
+    queue = make_queue(tmp_path, shards=40)
+    claimed = []
+
+    def work(owner):
+        while True:
+            shard = queue.claim(owner)
+            if shard is None:
+                return
+            claimed.append(shard[0])
+            assert queue.complete(shard[0], owner, f'{owner}.jsonl')
+
+    workers = [threading.Thread(target=work, args=(f'worker-{i}',)) for i in range(6)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert sorted(claimed) == list(range(40))
+    assert queue.counts()[DONE]['shards'] == 40
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+from transformers import CLIPImageProcessor
+
+from model_utils import ImageTooLarge, decode_image
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'uploads', 'sample_hodgkin.png')
+
+
+@pytest.fixture(scope='module')
+def processor():
+    # Default CLIP preprocessing: shortest edge 224, centre crop 224
+    return CLIPImageProcessor()
+
+
+def pixel_values(processor, image):
+    return processor(images=image, return_tensors='np')['pixel_values']
+
+
+def upscaled_sample(path, format, scale=3):
+    with Image.open(SAMPLE) as image:
+        image = image.convert('RGB')
+        image.resize((image.width * scale, image.height * scale), Image.BICUBIC).save(path, format=format)
+    return path
+
+
+@pytest.mark.parametrize('format, method', [('PNG', 'reduce'), ('JPEG', 'draft')])
+def test_reduced_decode_matches_full_resolution(tmp_path, processor, format, method):
+    path = upscaled_sample(str(tmp_path / ('large.' + format.lower())), format)
+    with Image.open(path) as image:
+        full = pixel_values(processor, image.convert('RGB'))
+
+    decoded, stats = decode_image(path)
+    assert method in stats['method']
+    assert min(decoded.size) >= 2 * 224
+    assert np.abs(pixel_values(processor, decoded) - full).mean() < 0.03
+
+
+def test_small_image_is_decoded_at_full_resolution(processor):
+    decoded, stats = decode_image(SAMPLE)
+    with Image.open(SAMPLE) as image:
+        assert decoded.size == image.size
+        full = pixel_values(processor, image.convert('RGB'))
+    assert np.array_equal(pixel_values(processor, decoded), full)
+
+
+def test_pixel_budget_is_enforced(tmp_path):
+    path = upscaled_sample(str(tmp_path / 'large.png'), 'PNG')
+    with pytest.raises(ImageTooLarge):
+        decode_image(path, max_pixels=1000 * 1000)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from embedding_index import EmbeddingIndex, IndexLocked
+
+DIM = 16
+
+
+def normalized(array):
+    return array / np.linalg.norm(array, axis=1, keepdims=True)
+
+
+def clustered_vectors(n, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((8, DIM))
+    return normalized(centres[rng.integers(0, 8, n)] + 0.3 * rng.standard_normal((n, DIM))).astype(np.float32)
+
+
+def test_second_writer_is_refused(tmp_path):
+    path = str(tmp_path / 'index')
+    writer = EmbeddingIndex(path, dim=DIM)
+    with pytest.raises(IndexLocked):
+        EmbeddingIndex(path)
+
+    # Readers never take the lock
+    writer.add(['a'], clustered_vectors(1))
+    reader = EmbeddingIndex(path, readonly=True)
+    assert 'a' in reader
+
+    writer.close()
+    with pytest.raises(RuntimeError):
+        writer.add(['b'], clustered_vectors(1))
+    EmbeddingIndex(path).add(['b'], clustered_vectors(1))
+
+
+def test_batched_cluster_search_matches_single_queries(tmp_path):
+    vectors = clustered_vectors(2000)
+    index = EmbeddingIndex(str(tmp_path / 'index'), dim=DIM)
+    index.add([str(i) for i in range(len(vectors))], vectors)
+    index.train(n_clusters=32)
+    index.remove(['0', '1', '2'])
+
+    queries = clustered_vectors(50, seed=1)
+    batched = index.search(queries, k=5, nprobe=4)
+    assert len(batched) == len(queries)
+    for query, results in zip(queries, batched):
+        single = index.search(query, k=5, nprobe=4)[0]
+        assert [ref_id for ref_id, _ in results] == [ref_id for ref_id, _ in single]
+        assert len(results) == 5
+        assert not {'0', '1', '2'} & {ref_id for ref_id, _ in results}
+
+
+def test_cluster_search_finds_exact_match(tmp_path):
+    vectors = clustered_vectors(500)
+    index = EmbeddingIndex(str(tmp_path / 'index'), dim=DIM)
+    index.add([str(i) for i in range(len(vectors))], vectors)
+    index.train(n_clusters=16)
+
+    results = index.search(vectors[[10, 20, 30]], k=3, nprobe=2)
+    assert [r[0][0] for r in results] == ['10', '20', '30']
+    assert all(r[0][1] == pytest.approx(1.0, abs=1e-2) for r in results)
@@ -0,0 +1,46 @@
+import os
+
+import torch
+from transformers import CLIPImageProcessor
+
+from model_utils import predict_image
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'uploads', 'sample_hodgkin.png')
+
+
+class FakeModel(object):
+    """Always predicts the last class; returns the given attention maps."""
+
+    def __init__(self, attentions):
+        self.attentions = attentions
+
+    def encode(self, pixel_values, output_attentions=False):
+        features = torch.ones(len(pixel_values), 4) / 2
+        if output_attentions:
+            return features, self.attentions
+        return features
+
+    def classify(self, features):
+        return torch.tensor([[0.0, 1.0, 5.0]]).expand(len(features), 3)
+
+
+def test_explain_returns_heatmap():
+    # 2 layers, 1 head, CLS + 4x4 patches
+    attentions = [torch.softmax(torch.randn(1, 1, 17, 17), dim=-1) for _ in range(2)]
+    details = {}
+    prediction, _, _ = predict_image(FakeModel(attentions), SAMPLE, CLIPImageProcessor(),
+                                     details=details, explain=True)
+    assert prediction == 'Hodgkin Lymphoma'
+    assert len(details['heatmap']) == 4
+    assert 'explain_ms' in details
+
+
+def test_failed_rollout_keeps_prediction():
+    details = {}
+    prediction, confidence, _ = predict_image(FakeModel([None]), SAMPLE, CLIPImageProcessor(),
+                                              details=details, explain=True)
+    assert prediction == 'Hodgkin Lymphoma'
+    assert float(confidence.rstrip('%')) > 90
+    assert 'heatmap' not in details
+    assert details['embedding'].shape == (4,)
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+import types
+
+import pytest
+import torch
+
+from model_registry import ModelRegistry
+from model_utils import build_classifier_head
+
+EMBEDDING_DIM = 8
+
+
+def fake_encoder():
+    # The registry only reads the projection size until a head is run
+    config = types.SimpleNamespace(projection_dim=EMBEDDING_DIM)
+    return types.SimpleNamespace(clip_model=types.SimpleNamespace(config=config))
+
+
+def save_head(path, num_classes=3):
+    head = build_classifier_head(EMBEDDING_DIM, num_classes)
+    torch.save({'classifier.' + key: value for key, value in head.state_dict().items()}, path)
+    return str(path)
+
+
+def write_manifest(path, heads, primary, canary=None, canary_percent=0):
+    with open(path, 'w') as f:
+        json.dump({'heads': heads, 'primary': primary,
+                   'canary': canary, 'canary_percent': canary_percent}, f)
+    return str(path)
+
+
+@pytest.fixture
+def registry():
+    return ModelRegistry(fake_encoder())
+
+
+def test_manifest_routes_primary_and_canary(tmp_path, registry):
+    heads = {'v1': save_head(tmp_path / 'v1.pth'), 'v2': save_head(tmp_path / 'v2.pth')}
+    registry.load_manifest(write_manifest(tmp_path / 'registry.json', heads, 'v1', 'v2', 50))
+
+    assert registry.status()['heads'] == ['v1', 'v2']
+    names = {registry.route(key=f'image-{i}')[0] for i in range(200)}
+    assert names == {'v1', 'v2'}
+    # The same key always lands on the same head
+    assert registry.route(key='image-7') == registry.route(key='image-7')
+
+
+def test_unloadable_head_leaves_registry_untouched(tmp_path, registry):
+    v1 = save_head(tmp_path / 'v1.pth')
+    manifest = tmp_path / 'registry.json'
+    registry.load_manifest(write_manifest(manifest, {'v1': v1}, 'v1'))
+    before = registry.status()
+    v1_model = registry.get('v1')
+
+    corrupt = tmp_path / 'v2.pth'
+    corrupt.write_bytes(b'not a checkpoint')
+    write_manifest(manifest, {'v2': str(corrupt)}, 'v2')
+    with pytest.raises(Exception):
+        registry.load_manifest(str(manifest))
+
+    assert registry.status() == before
+    assert registry.route() == ('v1', v1_model)
+
+
+def test_unknown_route_leaves_registry_untouched(tmp_path, registry):
+    v1 = save_head(tmp_path / 'v1.pth')
+    manifest = tmp_path / 'registry.json'
+    registry.load_manifest(write_manifest(manifest, {'v1': v1}, 'v1'))
+    before = registry.status()
+
+    # v2 loads fine, but the routes name a head that is not in the manifest
+    v2 = save_head(tmp_path / 'v2.pth')
+    write_manifest(manifest, {'v2': v2}, 'v3')
+    with pytest.raises(KeyError):
+        registry.load_manifest(str(manifest))
+
+    assert registry.status() == before
+    assert registry.route()[0] == 'v1'
+
+
+def test_refresh_keeps_serving_after_bad_manifest(tmp_path, registry):
+    v1 = save_head(tmp_path / 'v1.pth')
+    manifest = str(tmp_path / 'registry.json')
+    assert registry.refresh(write_manifest(manifest, {'v1': v1}, 'v1'), interval=0)
+
+    write_manifest(manifest, {'v1': v1, 'v2': str(tmp_path / 'missing.pth')}, 'v2')
+    os.utime(manifest, (0, 12345))
+    assert not registry.refresh(manifest, interval=0)
+    assert registry.route()[0] == 'v1'
+    assert registry.status()['heads'] == ['v1']
+
+
+def test_unchanged_heads_are_not_reloaded(tmp_path, registry):
+    v1 = save_head(tmp_path / 'v1.pth')
+    manifest = tmp_path / 'registry.json'
+    registry.load_manifest(write_manifest(manifest, {'v1': v1}, 'v1'))
+    v1_model = registry.get('v1')
+
+    v2 = save_head(tmp_path / 'v2.pth')
+    registry.load_manifest(write_manifest(manifest, {'v1': v1, 'v2': v2}, 'v2'))
+    assert registry.get('v1') is v1_model
+    assert registry.route()[0] == 'v2'
+
+
+def test_route_never_sees_a_removed_head(tmp_path, registry):
+    manifests = []
+    for i, name in enumerate(['a', 'b']):
+        path = save_head(tmp_path / f'{name}.pth')
+        manifests.append(write_manifest(tmp_path / f'{name}.json', {name: path}, name))
+    registry.load_manifest(manifests[0])
+
+    errors = []
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            try:
+                registry.route()
+            except Exception as e:
+                errors.append(e)
+                return
+            time.sleep(0)
+
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in readers:
+        thread.start()
+    for i in range(50):
+        registry.load_manifest(manifests[(i + 1) % 2])
+    stop.set()
+    for thread in readers:
+        thread.join()
+    assert errors == []
@@ -0,0 +1,72 @@
+import io
+import os
+
+from PIL import Image
+
+import upload_store as upload_store_module
+from upload_store import UploadStore
+
+
+def png_bytes(size=(64, 48), color='red'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def part_files(root):
+    return [f for _, _, filenames in os.walk(root) for f in filenames if f.endswith('.part')]
+
+
+def test_identical_uploads_are_stored_once(tmp_path):
+    store = UploadStore(str(tmp_path))
+    first = store.put(io.BytesIO(png_bytes()), 'PNG')
+    second = store.put(io.BytesIO(png_bytes()), 'png')
+    assert first == second
+    assert first.endswith('.png')
+    path, etag = store.lookup(first)
+    assert os.path.exists(path)
+    assert first.startswith(etag)
+
+
+def test_thumbnail_is_rendered_within_bounds(tmp_path):
+    store = UploadStore(str(tmp_path), thumbnail_size=32)
+    name = store.put(io.BytesIO(png_bytes((640, 480))), 'png')
+    path = store.thumbnail_path(name)
+    with Image.open(path) as thumb:
+        assert max(thumb.size) <= 32
+        assert thumb.format == 'JPEG'
+    assert store.thumbnail_path(name) == path
+
+
+def test_thumbnail_of_non_image_is_none(tmp_path):
+    store = UploadStore(str(tmp_path))
+    name = store.put(io.BytesIO(b'not an image at all'), 'jpg')
+    assert store.thumbnail_path(name) is None
+    assert part_files(str(tmp_path)) == []
+
+
+def count_scans(root, monkeypatch, low_watermark, uploads=50):
+    walks = []
+    real_walk = os.walk
+
+    def counting_walk(top, *args, **kwargs):
+        walks.append(top)
+        return real_walk(top, *args, **kwargs)
+
+    monkeypatch.setattr(upload_store_module.os, 'walk', counting_walk)
+
+    object_size = len(png_bytes(color=(0, 0, 0)))
+    store = UploadStore(root, max_bytes=20 * object_size, max_age=0, low_watermark=low_watermark)
+    walks.clear()
+    for i in range(uploads):
+        store.put(io.BytesIO(png_bytes(color=(i, i, i))), 'png')
+    assert store._total_bytes <= store.max_bytes
+    return len(walks)
+
+
+def test_eviction_leaves_headroom(tmp_path, monkeypatch):
+    exact = count_scans(str(tmp_path / 'exact'), monkeypatch, low_watermark=1.0)
+    headroom = count_scans(str(tmp_path / 'headroom'), monkeypatch, low_watermark=0.9)
+    # Trimming to exactly max_bytes rescans on every upload once full
+    assert exact >= 29
+    assert headroom <= exact * 2 // 3
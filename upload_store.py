@@ -0,0 +1,237 @@
+"""
+Content-addressed storage for uploaded images.
+
+Uploads are stored under the SHA-256 of their bytes, so identical images are
+kept once and two users uploading "image.jpg" never overwrite each other.
+The store keeps itself inside a size and age budget by evicting the least
+recently used objects (file atime is used as the access clock, which keeps
+the bookkeeping shared between gunicorn worker processes; mtime stays at the
+first write and serves as Last-Modified), and renders a thumbnail for each
+object the first time it is requested.
+
+Layout:
+    <root>/objects/ab/abcdef...1234.jpg
+    <root>/thumbs/ab/abcdef...1234.jpg
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+from model_utils import decode_image
+
+_NAME_RE = re.compile(r'^([0-9a-f]{64})\.([a-z0-9]+)$')
+
+
+class UploadStore(object):
+    """
+    Deduplicating upload store with LRU eviction.
+
+    Args:
+        root: Directory the store lives in
+        max_bytes: Total size budget for original uploads
+        max_age: Objects not accessed for this many seconds are evicted
+        thumbnail_size: Bounding box (pixels) for generated thumbnails
+        sweep_interval: Minimum seconds between age-based sweeps while the
+            store is within its size budget
+        low_watermark: Share of max_bytes to evict down to once the budget is
+            exceeded, so the full scan runs once per batch of uploads rather
+            than on every upload
+    """
+
+    def __init__(self, root, max_bytes=512 * 1024 * 1024, max_age=7 * 24 * 3600,
+                 thumbnail_size=256, sweep_interval=60, low_watermark=0.9):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.thumbs_dir = os.path.join(root, 'thumbs')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.thumbnail_size = thumbnail_size
+        self.sweep_interval = sweep_interval
+        self.low_watermark = low_watermark
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.thumbs_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._total_bytes = self._scan_total()
+        self._next_sweep = 0
+
+    def put(self, stream, extension, chunk_size=1024 * 1024):
+        """
+        Store an uploaded file.
+
+        Args:
+            stream: File-like object with the upload contents
+            extension: File extension without the dot (e.g. 'jpg')
+
+        Returns:
+            Store name of the object ('<sha256>.<ext>')
+        """
+        extension = extension.lower().lstrip('.')
+        digest = hashlib.sha256()
+        size = 0
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+
+            name = f"{digest.hexdigest()}.{extension}"
+            path = self.object_path(name)
+
+            if os.path.exists(path):
+                # Duplicate upload - keep the existing object, refresh its LRU clock
+                os.remove(tmp_path)
+                self._touch(path)
+                return name
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._total_bytes += size
+        self.evict(keep=name)
+        return name
+
+    def object_path(self, name):
+        """Absolute path of a stored original. Raises ValueError for invalid names."""
+        digest, ext = self._parse(name)
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}.{ext}")
+
+    def thumbnail_path(self, name):
+        """
+        Path of the thumbnail for a stored object, rendering it on first use.
+
+        Returns None if the original is no longer in the store or is not an
+        image that can be decoded.
+        """
+        digest, ext = self._parse(name)
+        source = self.object_path(name)
+        if not os.path.exists(source):
+            return None
+
+        # JPEG thumbnails keep repeat bandwidth small regardless of the original format
+        path = os.path.join(self.thumbs_dir, digest[:2], f"{digest}.jpg")
+        if os.path.exists(path):
+            return path
+
+        # Same reduced-resolution decode and pixel budget as inference
+        try:
+            image, _ = decode_image(source, min_side=self.thumbnail_size)
+        except (OSError, ValueError) as e:
+            # Allowed extension but not a decodable image, or over the budget
+            print(f"Cannot render thumbnail for {name}: {e}")
+            return None
+        image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                image.save(out, format='JPEG', quality=85)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+    def lookup(self, name):
+        """
+        Resolve a store name for serving.
+
+        Returns (path, etag) or None if the object does not exist. The
+        content hash doubles as a strong ETag since objects never change.
+        """
+        try:
+            path = self.object_path(name)
+        except ValueError:
+            return None
+        if not os.path.exists(path):
+            return None
+        self._touch(path)
+        return path, self._parse(name)[0]
+
+    def evict(self, keep=None):
+        """
+        Enforce the age and size budget, oldest access first. Once over
+        max_bytes, objects are evicted down to low_watermark * max_bytes.
+
+        Args:
+            keep: Store name that must not be evicted (the object just written)
+        """
+        with self._lock:
+            now = time.time()
+            if self._total_bytes <= self.max_bytes and (not self.max_age or now < self._next_sweep):
+                return
+            self._next_sweep = now + self.sweep_interval
+
+            entries = []
+            for dirpath, _, filenames in os.walk(self.objects_dir):
+                for filename in filenames:
+                    if not _NAME_RE.match(filename):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_atime, st.st_size, filename, path))
+
+            entries.sort()
+            total = sum(entry[1] for entry in entries)
+            target = self.max_bytes * self.low_watermark if total > self.max_bytes else self.max_bytes
+            for atime, size, filename, path in entries:
+                expired = self.max_age and now - atime > self.max_age
+                if total <= target and not expired:
+                    # Sorted by access time, so nothing later is expired either
+                    break
+                if filename == keep:
+                    continue
+                self._remove(filename, path)
+                total -= size
+
+            self._total_bytes = total
+
+    def _remove(self, filename, path):
+        digest = _NAME_RE.match(filename).group(1)
+        thumb = os.path.join(self.thumbs_dir, digest[:2], f"{digest}.jpg")
+        for target in (path, thumb):
+            try:
+                os.remove(target)
+            except FileNotFoundError:
+                pass
+
+    def _touch(self, path):
+        # Only the access time moves; mtime is the object's creation time
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except FileNotFoundError:
+            pass
+
+    def _scan_total(self):
+        total = 0
+        for dirpath, _, filenames in os.walk(self.objects_dir):
+            for filename in filenames:
+                if _NAME_RE.match(filename):
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+        return total
+
+    @staticmethod
+    def _parse(name):
+        match = _NAME_RE.match(name)
+        if not match:
+            raise ValueError(f"Invalid store name: {name}")
+        return match.group(1), match.group(2)